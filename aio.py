@@ -0,0 +1,148 @@
+# -*- Mode: Python -*-
+
+# run CPS code inside an asyncio event loop: the same schedule/run
+#   interface as scheduler.py (convert with 'trampoline.py --runtime=aio').
+#
+# Continuations are not handed to the loop one at a time: they go on our
+#   own queue, and a single loop.call_soon() callback drains it in batches
+#   of at most <batch> per tick, rescheduling itself while there's more.
+#   So a task tree that bounces a million times costs the loop a thousand
+#   callbacks, and other asyncio code still gets a turn every <batch>
+#   continuations.
+#
+# run() only blocks when no loop is running (e.g. a converted script run
+#   from the command line): it then runs a loop until the queue and every
+#   awaited thing are done.  Called with a loop running, it returns at once
+#   and the work proceeds in that loop; 'await drained()' waits for it.
+#
+# adapters:
+#   cps_await (k, awaitable)    CPS primitive: continue with the awaitable's result
+#   as_future (fun, *args)      call the cps_ function fun(k, *args), and
+#                               return an asyncio future for its result
+
+import asyncio
+from collections import deque
+
+# continuations run per loop callback
+batch = 1000
+
+tasks = deque()
+# the loop we're running in
+loop = None
+# a tick is queued with the loop
+_pending = False
+# awaitables we're waiting on for cps_await
+_outstanding = 0
+# futures from drained()
+_waiters = []
+
+def _get_loop():
+    global loop
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        if loop is None or loop.is_closed():
+            loop = asyncio.new_event_loop()
+    return loop
+
+def schedule (fun, *args):
+    global _pending
+    tasks.append ((fun, args))
+    if not _pending:
+        _pending = True
+        _get_loop().call_soon (_tick)
+
+# the fixed-arity entry points that trampoline output calls.
+schedule0 = schedule1 = schedule2 = schedule
+
+def _tick():
+    global _pending
+    popleft = tasks.popleft
+    n = batch
+    try:
+        # including anything scheduled by this batch, up to the limit.
+        while tasks and n:
+            fun, args = popleft()
+            fun (*args)
+            n -= 1
+    except BaseException as e:
+        if _standalone:
+            # like scheduler.run(), stop at the first error.
+            _wake (e)
+            return
+        # the loop's exception handler gets it; the rest carry on.
+        raise
+    finally:
+        if tasks:
+            loop.call_soon (_tick)
+        else:
+            _pending = False
+            if not _outstanding:
+                _wake()
+
+def _wake (error=None):
+    while _waiters:
+        f = _waiters.pop()
+        if not f.done():
+            if error is None:
+                f.set_result (None)
+            else:
+                f.set_exception (error)
+
+def drained():
+    "return a future that's done when nothing is queued or awaited"
+    f = _get_loop().create_future()
+    if not tasks and not _outstanding:
+        f.set_result (None)
+    else:
+        _waiters.append (f)
+    return f
+
+# run() is driving its own loop
+_standalone = False
+
+def run():
+    global _standalone, _pending
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        # already inside a loop: the queued tick will do the work.
+        return
+    l = _get_loop()
+    _standalone = True
+    try:
+        l.run_until_complete (drained())
+    finally:
+        _standalone = False
+        _pending = False
+        tasks.clear()
+
+def _raise (e):
+    raise e
+
+def _awaited (k, future):
+    global _outstanding
+    _outstanding -= 1
+    if future.cancelled():
+        schedule (_raise, asyncio.CancelledError())
+    elif future.exception() is not None:
+        schedule (_raise, future.exception())
+    else:
+        schedule (k, future.result())
+
+def cps_await (k, awaitable):
+    "CPS primitive: wait for <awaitable> in the loop, and continue with its result"
+    global _outstanding
+    _outstanding += 1
+    asyncio.ensure_future (awaitable, loop=_get_loop()).add_done_callback (lambda future: _awaited (k, future))
+
+def as_future (fun, *args):
+    "call the cps_ function fun(k, *args), returning a future for what it passes to k"
+    f = _get_loop().create_future()
+    def k (*result):
+        if not f.done():
+            f.set_result (result[0] if result else None)
+    schedule (fun, k, *args)
+    return f
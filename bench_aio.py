@@ -0,0 +1,84 @@
+# -*- Mode: Python -*-
+
+# aio.py's batched bridge against the naive one (every continuation a
+#   loop.call_soon() of its own), running tak in CPS inside an asyncio
+#   loop.  A ticker coroutine runs alongside, to show how long the rest of
+#   the loop has to wait for a turn.
+#
+# usage: python bench_aio.py [batch ...]
+
+import asyncio
+import sys
+import time
+
+import aio
+
+def make_tak (schedule):
+    # tak as the trampoline would emit it, with every call bounced.
+    def cps_tak (k, x, y, z):
+        if not y < x:
+            schedule (k, z)
+        else:
+            def k1 (a):
+                def k2 (b):
+                    def k3 (c):
+                        schedule (cps_tak, k, a, b, c)
+                    schedule (cps_tak, k3, z - 1, x, y)
+                schedule (cps_tak, k2, y - 1, z, x)
+            schedule (cps_tak, k1, x - 1, y, z)
+    return cps_tak
+
+def count_bounces (args):
+    n = [0]
+    q = []
+    def schedule (fun, *a):
+        n[0] += 1
+        q.append ((fun, a))
+    schedule (make_tak (schedule), lambda v: None, *args)
+    while q:
+        fun, a = q.pop()
+        fun (*a)
+    return n[0]
+
+async def bench (schedule, args):
+    loop = asyncio.get_running_loop()
+    gaps = []
+    done = False
+    async def ticker():
+        t = loop.time()
+        while not done:
+            await asyncio.sleep (0)
+            now = loop.time()
+            gaps.append (now - t)
+            t = now
+    tk = asyncio.ensure_future (ticker())
+    await asyncio.sleep (0)
+    f = loop.create_future()
+    t0 = time.perf_counter()
+    schedule (make_tak (schedule), f.set_result, *args)
+    await f
+    elapsed = time.perf_counter() - t0
+    done = True
+    await tk
+    return elapsed, max (gaps)
+
+def main (args):
+    batches = [ int (x) for x in args ] or [100, 1000, 10000]
+    targs = (22, 16, 8)
+    n = count_bounces (targs)
+    print ('tak%r: %d continuations' % (targs, n))
+    print ('%-16s %9s %12s %14s' % ('', 'time', 'cont/s', 'max loop lag'))
+    def report (name, r):
+        elapsed, lag = r
+        print ('%-16s %8.3fs %12.0f %12.3fms' % (name, elapsed, n / elapsed, lag * 1000))
+    async def naive():
+        return await bench (asyncio.get_running_loop().call_soon, targs)
+    report ('naive call_soon', asyncio.run (naive()))
+    for b in batches:
+        aio.batch = b
+        async def batched():
+            return await bench (aio.schedule, targs)
+        report ('batch=%d' % (b,), asyncio.run (batched()))
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
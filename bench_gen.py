@@ -0,0 +1,149 @@
+# -*- Mode: Python -*-
+
+# the generator backend (coroutine.py) against the closure-based
+#   trampoline, on tak, fib and a deep recursion: each program is converted by each backend,
+#   then run <repeat> times for the best time, and once more under
+#   tracemalloc for the peak memory allocated while it ran.
+#
+# usage: python bench_gen.py [--repeat=N] [tak|fib|deep ...]
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import coroutine
+import scheduler
+import trampoline
+
+PROGRAMS = {
+    'tak': ('''
+def empty():
+    return []
+
+results = empty()
+
+@cps_manual
+def cps_keep (k, v):
+    results.append (v)
+    k()
+
+def cps_tak (x, y, z):
+    if y >= x:
+        return z
+    else:
+        return cps_tak (
+            cps_tak (x-1, y, z),
+            cps_tak (y-1, z, x),
+            cps_tak (z-1, x, y)
+            )
+
+cps_keep (cps_tak (22, 16, 8))
+''', 9),
+    'fib': ('''
+def empty():
+    return []
+
+results = empty()
+
+@cps_manual
+def cps_keep (k, v):
+    results.append (v)
+    k()
+
+def cps_fib (n):
+    if n < 2:
+        return n
+    else:
+        return cps_fib (n-1) + cps_fib (n-2)
+
+cps_keep (cps_fib (24))
+''', 46368),
+    # recursion 100000 deep: memory held grows with the depth.  Under the
+    #   trampoline only returns bounce; the calls themselves nest on the
+    #   python stack, so it stops at the recursion limit.
+    'deep': ('''
+def empty():
+    return []
+
+results = empty()
+
+@cps_manual
+def cps_keep (k, v):
+    results.append (v)
+    k()
+
+def cps_count (n):
+    if n == 0:
+        return 0
+    else:
+        return 1 + cps_count (n-1)
+
+cps_keep (cps_count (100000))
+''', 100000),
+    }
+
+BACKENDS = [
+    ('trampoline', lambda path: trampoline.dofile (path)),
+    ('trampoline -O', lambda path: trampoline.dofile (path, optimize=True)),
+    ('generators', lambda path: coroutine.dofile (path)),
+    ]
+
+def convert (src, backend, directory):
+    "convert <src> with <backend>, and return the output compiled"
+    path = os.path.join (directory, 'prog.py')
+    with open (path, 'w') as f:
+        f.write (src)
+    backend (path)
+    with open (os.path.join (directory, 'prog.cps.py')) as f:
+        return compile (f.read(), 'prog.cps.py', 'exec')
+
+def execute (code, expected):
+    env = {'__name__': 'prog'}
+    exec (code, env)
+    assert env['results'] == [expected], env['results']
+
+def measure (code, expected, repeat):
+    "(best seconds, peak bytes)"
+    best = None
+    for i in range (repeat):
+        t0 = time.perf_counter()
+        execute (code, expected)
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    tracemalloc.start()
+    execute (code, expected)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def main (args):
+    repeat = 5
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg.startswith ('--repeat='):
+            repeat = int (arg[9:])
+        else:
+            raise SystemExit ('unknown option %r' % (arg,))
+    names = args or ['tak', 'fib', 'deep']
+    print ('%-6s %-14s %9s %9s %10s' % ('', 'backend', 'seconds', 'speedup', 'peak KB'))
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            src, expected = PROGRAMS[name]
+            base = None
+            for label, backend in BACKENDS:
+                code = convert (src, backend, directory)
+                try:
+                    seconds, peak = measure (code, expected, repeat)
+                except RecursionError:
+                    # the trampoline bounces returns, but calls still nest.
+                    print ('%-6s %-14s %9s' % (name, label, 'recursion limit'))
+                    continue
+                if base is None:
+                    base = seconds
+                print ('%-6s %-14s %9.3f %8.2fx %10.0f' % (name, label, seconds, base / seconds, peak / 1024))
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
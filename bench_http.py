@@ -0,0 +1,168 @@
+# -*- Mode: Python -*-
+
+# end-to-end benchmark: httpd.py's server and load generator, converted
+#   with trampoline.py, talking over loopback.  The server runs in a
+#   forked process with its own scheduler loop; this one runs the load
+#   generator at each concurrency level in turn, and reports requests per
+#   second, latency percentiles, and scheduler bounces per request on each
+#   side (the server's are fetched from its GET /stats).
+#
+# as a regression gate: save a run with --json, and pass it back with
+#   --baseline=FILE after a change to the runtime or the code generator.
+#   The exit status is 1 if any level's requests/s dropped, or its bounces
+#   per request rose, by more than --tolerance (a fraction, default 0.1).
+#   Bounces don't depend on the machine, so they're the sharper test.
+#
+# usage: python bench_http.py [-O] [--inline] [--depth=N] [--requests=N]
+#                             [--json] [--baseline=FILE] [--tolerance=X]
+#                             [concurrency ...]
+
+import importlib.util
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+import scheduler
+import trampoline
+
+def load (options):
+    "convert httpd.py with the trampoline, and import the result"
+    path = os.path.join (os.path.dirname (os.path.abspath (__file__)), 'httpd.py')
+    trampoline.dofile (path, **options)
+    spec = importlib.util.spec_from_file_location ('httpd_cps', path[:-3] + '.cps.py')
+    module = importlib.util.module_from_spec (spec)
+    spec.loader.exec_module (module)
+    return module
+
+def start_server (httpd):
+    lsock = httpd.listener()
+    address = lsock.getsockname()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            scheduler.schedule (httpd.cps_serve, httpd.done, lsock)
+            scheduler.run()
+        finally:
+            os._exit (0)
+    lsock.close()
+    return pid, address
+
+def server_stats (address):
+    "(bounces, requests served) from the server"
+    s = socket.create_connection (address)
+    s.sendall (b'GET /stats HTTP/1.1\r\nConnection: close\r\n\r\n')
+    data = b''
+    while 1:
+        block = s.recv (4096)
+        if not block:
+            break
+        data += block
+    s.close()
+    bounces, served = data.split (b'\r\n\r\n', 1)[1].split()
+    return int (bounces), int (served)
+
+def level (httpd, address, clients, requests, depth):
+    stats = httpd.latencies()
+    each = max (depth, requests // clients)
+    b0, s0 = server_stats (address)
+    c0 = scheduler.bounces
+    for i in range (clients):
+        c = httpd.http_client (each, depth, stats)
+        scheduler.schedule (httpd.cps_client, httpd.done, address, c)
+    t0 = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - t0
+    b1, s1 = server_stats (address)
+    n = clients * each
+    # the second /stats request is counted in s1.
+    assert s1 - s0 - 1 == n == len (stats.samples)
+    return {
+        'concurrency': clients,
+        'requests': n,
+        'seconds': elapsed,
+        'rps': n / elapsed,
+        'p50': stats.percentile (0.5),
+        'p90': stats.percentile (0.9),
+        'p99': stats.percentile (0.99),
+        'max': stats.percentile (1.0),
+        'server_bounces': (b1 - b0) / n,
+        'client_bounces': (scheduler.bounces - c0) / n,
+        }
+
+def compare (results, baseline, tolerance):
+    "return a list of regressions against <baseline>"
+    before = { r['concurrency'] : r for r in baseline }
+    bad = []
+    for r in results:
+        b = before.get (r['concurrency'])
+        if b is None:
+            continue
+        if r['rps'] < b['rps'] * (1 - tolerance):
+            bad.append ('c=%d: %.0f req/s, was %.0f' % (r['concurrency'], r['rps'], b['rps']))
+        for side in ('server_bounces', 'client_bounces'):
+            if r[side] > b[side] * (1 + tolerance):
+                bad.append ('c=%d: %s %.2f/req, was %.2f' % (r['concurrency'], side, r[side], b[side]))
+    return bad
+
+def main (args):
+    options = {}
+    depth = 1
+    requests = 20000
+    as_json = False
+    baseline = None
+    tolerance = 0.1
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg == '-O':
+            options['optimize'] = True
+        elif arg == '--inline':
+            options['inline'] = True
+        elif arg.startswith ('--depth='):
+            depth = int (arg[8:])
+        elif arg.startswith ('--requests='):
+            requests = int (arg[11:])
+        elif arg == '--json':
+            as_json = True
+        elif arg.startswith ('--baseline='):
+            baseline = arg[11:]
+        elif arg.startswith ('--tolerance='):
+            tolerance = float (arg[12:])
+        else:
+            raise SystemExit ('unknown option %r' % (arg,))
+    levels = [ int (x) for x in args ] or [1, 10, 100, 1000, 10000]
+    httpd = load (options)
+    pid, address = start_server (httpd)
+    results = []
+    try:
+        for clients in levels:
+            r = level (httpd, address, clients, requests, depth)
+            results.append (r)
+            if not as_json:
+                if len (results) == 1:
+                    print ('pipeline depth %d' % (depth,))
+                    print ('%7s %8s %9s %8s %8s %8s %8s %9s %9s' % (
+                        'conns', 'reqs', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'srv b/r', 'cli b/r'
+                        ))
+                print ('%7d %8d %9.0f %8.2f %8.2f %8.2f %8.2f %9.2f %9.2f' % (
+                    clients, r['requests'], r['rps'],
+                    r['p50'] * 1000, r['p90'] * 1000, r['p99'] * 1000, r['max'] * 1000,
+                    r['server_bounces'], r['client_bounces'],
+                    ))
+    finally:
+        os.kill (pid, signal.SIGTERM)
+        os.waitpid (pid, 0)
+    if as_json:
+        print (json.dumps (results, indent=1))
+    if baseline is not None:
+        with open (baseline) as f:
+            bad = compare (results, json.load (f), tolerance)
+        for line in bad:
+            print ('regression: %s' % (line,), file=sys.stderr)
+        if bad:
+            sys.exit (1)
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
@@ -0,0 +1,109 @@
+# -*- Mode: Python -*-
+
+# pool.py against a loopback stand-in for a backend: a threaded server
+#   that greets each new connection after a simulated handshake delay,
+#   then answers one line per request line.  The same client workload is
+#   run through the pool, and without it (every connection is released
+#   with reuse=False, so each request opens its own).
+#
+# usage: python bench_pool.py [requests [clients [max-size [handshake-ms]]]]
+
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import pool
+import scheduler
+
+class _handler (socketserver.StreamRequestHandler):
+    def handle (self):
+        time.sleep (self.server.handshake)
+        self.wfile.write (b'hello\n')
+        for line in self.rfile:
+            self.wfile.write (b'ok ' + line)
+
+class _server (socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_server (handshake):
+    server = _server (('127.0.0.1', 0), _handler)
+    server.handshake = handshake
+    threading.Thread (target=server.serve_forever, daemon=True).start()
+    return server
+
+def connect (address):
+    sock = socket.create_connection (address)
+    sock.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # the handshake
+    read_line (sock)
+    return sock
+
+def read_line (sock):
+    data = b''
+    while not data.endswith (b'\n'):
+        block = sock.recv (4096)
+        if not block:
+            raise EOFError
+        data += block
+    return data
+
+def talk (sock, n):
+    sock.sendall (b'%d\n' % (n,))
+    return read_line (sock)
+
+def bench (address, nrequests, nclients, max_size, reuse):
+    p = pool.pool (max_size, connect=connect)
+    latencies = []
+    host, port = address
+    # each client is a loop of acquire/request/release, written out as
+    #   continuations by hand.
+    def client (n):
+        if n == 0:
+            return
+        t0 = time.perf_counter()
+        def got_conn (sock):
+            scheduler.cps_run_in_thread (lambda reply: got_reply (sock, reply), talk, sock, n)
+        def got_reply (sock, reply):
+            p.cps_release (lambda: done(), sock, reuse)
+        def done():
+            latencies.append (time.perf_counter() - t0)
+            scheduler.schedule (client, n - 1)
+        p.cps_acquire (got_conn, host, port)
+    for i in range (nclients):
+        scheduler.schedule (client, nrequests // nclients)
+    t0 = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - t0
+    p.close()
+    latencies.sort()
+    n = len (latencies)
+    return {
+        'requests': n,
+        'opened_per_1k': p.opened * 1000.0 / n,
+        'mean_ms': sum (latencies) / n * 1000,
+        'p50_ms': latencies[n // 2] * 1000,
+        'p99_ms': latencies[min (n - 1, int (n * 0.99))] * 1000,
+        'req_per_s': n / elapsed,
+        }
+
+def main (args):
+    nrequests = int (args[0]) if len (args) > 0 else 5000
+    nclients = int (args[1]) if len (args) > 1 else 16
+    max_size = int (args[2]) if len (args) > 2 else 8
+    handshake = float (args[3]) / 1000 if len (args) > 3 else 0.001
+    server = start_server (handshake)
+    address = server.server_address
+    print ('%d requests, %d clients, max_size=%d, handshake=%.1fms' % (nrequests, nclients, max_size, handshake * 1000))
+    print ('%-8s %12s %9s %9s %9s %9s' % ('', 'conns/1k', 'mean ms', 'p50 ms', 'p99 ms', 'req/s'))
+    for name, reuse in (('no pool', False), ('pool', True)):
+        r = bench (address, nrequests, nclients, max_size, reuse)
+        print ('%-8s %12.1f %9.3f %9.3f %9.3f %9.0f' % (
+            name, r['opened_per_1k'], r['mean_ms'], r['p50_ms'], r['p99_ms'], r['req_per_s']
+            ))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
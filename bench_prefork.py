@@ -0,0 +1,192 @@
+# -*- Mode: Python -*-
+
+# multi-process scaling over loopback: httpd.py's server, converted with
+#   trampoline.py, run by prefork.py with 1, 2, 4 ... workers, each on its
+#   own SO_REUSEPORT listener.  The load comes from <procs> forked client
+#   processes, each running <conns> connections at a time with httpd's
+#   load generator, so the clients aren't the bottleneck.  A connection
+#   is kept alive for <keepalive> requests, then a new one is made.
+#   Reported per worker count: requests per second, the speedup over one
+#   worker and the efficiency (speedup / workers) - only if 1 is among
+#   the worker counts, as it's measured, not assumed - and how the kernel
+#   spread the requests over the workers (from their stats, over the
+#   control pipes).
+#
+#   Scaling stops at the number of cores - with clients, kernel and
+#   workers all competing for them - so on a small machine the speedup
+#   levels off early; the number of cores is printed with the results.
+#
+# with --restart, every worker is replaced (prefork.restart()) once half
+#   the requests have been served, and the run fails if any request is
+#   lost, any connection refused or reset, or if the new workers served
+#   none (the clients need more than one round of connections for that:
+#   a connection stays with the worker that accepted it).  The replaced
+#   workers are listed too, before the new ones.
+#
+# usage: python bench_prefork.py [-O] [--requests=N] [--procs=N] [--conns=N]
+#                                [--keepalive=N] [--depth=N] [--restart]
+#                                [--json] [workers ...]
+
+import json
+import os
+import select
+import sys
+import time
+
+import scheduler
+import bench_http
+from prefork import prefork
+
+def client_process (httpd, address, conns, requests, keepalive, depth, wfd):
+    # in a forked child: run <conns> connections at a time until
+    #   <requests> have been made, and write back (requests, seconds) as JSON.
+    scheduler.tasks.clear()
+    stats = httpd.latencies()
+    t0 = time.perf_counter()
+    for i in range (max (1, requests // (conns * keepalive))):
+        for j in range (conns):
+            c = httpd.http_client (keepalive, depth, stats)
+            scheduler.schedule (httpd.cps_client, httpd.done, address, c)
+        scheduler.run()
+    elapsed = time.perf_counter() - t0
+    os.write (wfd, bytes (json.dumps ({'requests': len (stats.samples), 'seconds': elapsed}), 'utf-8'))
+
+def load (httpd, group, procs, conns, requests, keepalive, depth, restart, sent):
+    "run the clients against <group>, and return (requests answered, wall seconds, pids of new workers)"
+    children = []
+    t0 = time.perf_counter()
+    for i in range (procs):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close (r)
+                client_process (httpd, group.address, conns, requests // procs, keepalive, depth, w)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit (status)
+        os.close (w)
+        children.append ((pid, r))
+    replacements = set()
+    if restart:
+        # restart while the clients are half way through.
+        pipes = [ r for pid, r in children ]
+        while group.stats()['total'].get ('served', 0) < sent // 2:
+            readable, _, _ = select.select (pipes, [], [], 0.01)
+            if len (readable) == len (pipes):
+                # every client is done (or failed): too late.
+                break
+        group.restart()
+        replacements = set (group.workers)
+    answered = 0
+    failed = 0
+    for pid, r in children:
+        data = b''
+        while 1:
+            block = os.read (r, 4096)
+            if not block:
+                break
+            data += block
+        os.close (r)
+        pid, status = os.waitpid (pid, 0)
+        if status or not data:
+            failed += 1
+        else:
+            answered += json.loads (data)['requests']
+    elapsed = time.perf_counter() - t0
+    if failed:
+        raise SystemExit ('%d client processes failed' % (failed,))
+    return answered, elapsed, replacements
+
+def level (httpd, nworkers, procs, conns, requests, keepalive, depth, restart):
+    sent = procs * max (1, requests // procs // (conns * keepalive)) * conns * keepalive
+    group = prefork (httpd.cps_serve, nworkers, stats=lambda: {'served': httpd.served})
+    try:
+        group.start()
+        answered, elapsed, replacements = load (httpd, group, procs, conns, requests, keepalive, depth, restart, sent)
+    finally:
+        group.close()
+    # with every worker stopped, the totals are final, replaced ones included.
+    total = group.stats()['total']
+    served = [ r['served'] for r in group.retired ]
+    if answered != sent or total['served'] != sent:
+        raise SystemExit ('%d workers: sent %d, answered %d, served %d' % (
+            nworkers, sent, answered, total['served']
+            ))
+    if restart and not sum (r['served'] for r in group.retired if r['pid'] in replacements):
+        raise SystemExit ('%d workers: the new workers served no requests' % (nworkers,))
+    return {
+        'workers': nworkers,
+        'requests': answered,
+        'seconds': elapsed,
+        'rps': answered / elapsed,
+        'served': served,
+        'restarts': total['restarts'],
+        }
+
+def main (args):
+    options = {}
+    requests = 80000
+    procs = max (2, os.cpu_count() or 1)
+    conns = 32
+    keepalive = 100
+    depth = 1
+    restart = False
+    as_json = False
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg == '-O':
+            options['optimize'] = True
+        elif arg.startswith ('--requests='):
+            requests = int (arg[11:])
+        elif arg.startswith ('--procs='):
+            procs = int (arg[8:])
+        elif arg.startswith ('--conns='):
+            conns = int (arg[8:])
+        elif arg.startswith ('--keepalive='):
+            keepalive = int (arg[12:])
+        elif arg.startswith ('--depth='):
+            depth = int (arg[8:])
+        elif arg == '--restart':
+            restart = True
+        elif arg == '--json':
+            as_json = True
+        else:
+            raise SystemExit ('unknown option %r' % (arg,))
+    levels = [ int (x) for x in args ] or [1, 2, 4]
+    httpd = bench_http.load (options)
+    results = [ level (httpd, nworkers, procs, conns, requests, keepalive, depth, restart) for nworkers in levels ]
+    # the speedup is over a measured single worker, if there is one.
+    base = None
+    for r in results:
+        if r['workers'] == 1:
+            base = r['rps']
+    for r in results:
+        if base is None:
+            r['speedup'] = r['efficiency'] = None
+        else:
+            r['speedup'] = r['rps'] / base
+            r['efficiency'] = r['speedup'] / r['workers']
+    if as_json:
+        print (json.dumps (results, indent=1))
+        return
+    print ('%d cores, %d client processes x %d connections of %d requests, pipeline depth %d%s' % (
+        os.cpu_count() or 1, procs, conns, keepalive, depth, ', restarting under load' if restart else ''
+        ))
+    print ('%7s %8s %9s %8s %6s  %s' % ('workers', 'reqs', 'req/s', 'speedup', 'eff', 'served by each worker'))
+    for r in results:
+        if r['speedup'] is None:
+            scaling = '%8s %6s' % ('-', '-')
+        else:
+            scaling = '%7.2fx %5.0f%%' % (r['speedup'], r['efficiency'] * 100)
+        print ('%7d %8d %9.0f %s  %s' % (
+            r['workers'], r['requests'], r['rps'], scaling,
+            ' '.join (str (n) for n in r['served'])
+            ))
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
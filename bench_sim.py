@@ -0,0 +1,71 @@
+# -*- Mode: Python -*-
+
+# a capacity-planning run on sim.py's virtual clock: <clients> clients
+#   each send <requests> requests, one at a time with think time between,
+#   to a simulated service over a link with jittered latency, giving up on
+#   any that take longer than the timeout.  Every request sets two timers
+#   on the link, one for service and one for the timeout, plus one for
+#   think time: with the defaults that's well over a million timers.  The
+#   report is in virtual time; the last line says how long it took for real.
+#
+# usage: python bench_sim.py [clients [requests [workers [seed]]]]
+
+import sys
+import time
+
+import sim
+
+def scenario (clients, requests, workers, seed):
+    sim.reset()
+    sim.seed (seed)
+    service = sim.endpoint (
+        # 2ms round trip, with a tail
+        latency = lambda r: 0.001 + r.expovariate (1 / 0.0002),
+        # 0.5ms mean service time per request
+        service = lambda r: r.expovariate (1 / 0.0005),
+        concurrency = workers,
+        name = 'service',
+        )
+    st = sim.stats ('requests')
+    # what the trampoline would emit for:
+    #
+    #   def cps_client (k, n):
+    #       while n:
+    #           t0 = sim.now
+    #           ok, reply = cps_with_timeout (0.1, service.cps_request, n)
+    #           ...
+    #           cps_sleep (think time)
+    #           n -= 1
+    def cps_client (k, n):
+        if not n:
+            sim.schedule (k)
+            return
+        t0 = sim.now
+        def k1 (result):
+            ok, reply = result
+            if ok:
+                st.record (sim.now - t0)
+            else:
+                st.error()
+            def k2():
+                sim.schedule (cps_client, k, n - 1)
+            sim.cps_sleep (k2, sim.rng().expovariate (1 / 0.05))
+        sim.cps_with_timeout (k1, 0.1, service.cps_request, n)
+    for i in range (clients):
+        # stagger the start over the first second.
+        sim.call_later (i / clients, cps_client, lambda: None, requests)
+    t0 = time.perf_counter()
+    sim.run()
+    elapsed = time.perf_counter() - t0
+    return st, service, elapsed
+
+def main (args):
+    clients, requests, workers, seed = ([ int (x) for x in args ] + [1000, 300, 12, 0][len (args):])[:4]
+    st, service, elapsed = scenario (clients, requests, workers, seed)
+    print ('%d clients x %d requests, %d workers, seed %d' % (clients, requests, workers, seed))
+    print (st.report())
+    print ('utilization %.1f%%, max queue %d' % (service.utilization() * 100, service.max_queue))
+    print ('%.3fs virtual in %.2fs wall' % (sim.now, elapsed))
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
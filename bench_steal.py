@@ -0,0 +1,65 @@
+# -*- Mode: Python -*-
+
+# throughput of steal.py from 1 to N threads, on tak and on a workload of
+#   many small independent tasks.  Only interesting on a free-threaded
+#   build; with the GIL expect flat or falling numbers.
+#
+# usage: python bench_steal.py [max-threads]
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import trampoline
+
+here = os.path.dirname (os.path.abspath (__file__))
+
+def bench_tak (tak_path, n):
+    # run the trampolined tak in a fresh process, since steal.py reads
+    #   CPS_THREADS at import.
+    env = dict (os.environ, CPS_THREADS=str (n), PYTHONPATH=here)
+    t0 = time.perf_counter()
+    subprocess.run ([sys.executable, tak_path], env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+def bench_small (n, ntasks=200000, fanout=8):
+    import steal
+    def leaf (i):
+        # a little arithmetic, standing in for real work
+        x = 0
+        for j in range (20):
+            x += i * j
+    def node (depth, i):
+        if depth:
+            for j in range (fanout):
+                steal.schedule (node, depth - 1, i * fanout + j)
+        else:
+            leaf (i)
+    depth = 0
+    while fanout ** depth < ntasks:
+        depth += 1
+    steal.schedule (node, depth, 0)
+    t0 = time.perf_counter()
+    steal.run (n)
+    return time.perf_counter() - t0, sum (steal.last_pool.ran)
+
+def main (args):
+    maxn = int (args[0]) if args else (os.cpu_count() or 1)
+    tmp = tempfile.mkdtemp()
+    src = os.path.join (tmp, 'tak.py')
+    shutil.copy (os.path.join (here, 'tak.py'), src)
+    trampoline.dofile (src, runtime='steal')
+    tak_path = os.path.join (tmp, 'tak.cps.py')
+    print ('threads        tak     small-tasks (tasks/s)')
+    n = 1
+    while n <= maxn:
+        t = bench_tak (tak_path, n)
+        s, ran = bench_small (n)
+        print ('%7d  %8.3fs  %10.0f' % (n, t, ran / s))
+        n *= 2
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
@@ -0,0 +1,115 @@
+# -*- Mode: Python -*-
+
+# bounded channels between CPS tasks.
+#
+# a channel holds up to <capacity> items.  cps_put parks the producer's
+#   continuation while the channel is full, and cps_get parks the
+#   consumer's while it's empty; parked continuations are woken in FIFO
+#   order as room or items appear.  A put that finds a consumer waiting
+#   hands the item straight over.  When nothing has to wait, the
+#   continuation is called directly rather than through the scheduler.
+#
+#   from channel import cps_channel
+#
+#   def cps_producer (ch):
+#       i = 0
+#       while i < 1000:
+#           ch.cps_put (i)
+#           i = i + 1
+#       else:
+#           ch.cps_put (None)
+#       return i
+#
+# cps_get_many (n) takes up to <n> items per wakeup, which saves a bounce
+#   per item when the consumer can keep up with batches.
+#
+# a parked continuation whose task tree has been cancelled is skipped when
+#   its turn comes (and a cancelled put never happens).
+
+from collections import deque
+import scheduler
+from scheduler import schedule_in
+
+def _live (waiters):
+    # drop parked entries from cancelled trees off the front.
+    while waiters:
+        tok = waiters[0][-1]
+        if tok is None or not tok.cancelled:
+            return True
+        waiters.popleft()
+    return False
+
+class channel:
+
+    def __init__ (self, capacity=1):
+        self.capacity = capacity
+        self.items = deque()
+        # parked continuations: (k, item, token) for puts, (k, token) for gets
+        self.putters = deque()
+        self.getters = deque()
+
+    def __len__ (self):
+        return len (self.items)
+
+    def __repr__ (self):
+        return '<channel %d/%d putters=%d getters=%d>' % (
+            len (self.items), self.capacity, len (self.putters), len (self.getters)
+            )
+
+    def _refill (self):
+        # move parked puts into the buffer while there's room
+        while len (self.items) < self.capacity and _live (self.putters):
+            k, item, tok = self.putters.popleft()
+            self.items.append (item)
+            schedule_in (tok, k)
+
+    def cps_put (self, k, item):
+        if _live (self.getters):
+            gk, tok = self.getters.popleft()
+            schedule_in (tok, gk, item)
+            k()
+        elif len (self.items) < self.capacity:
+            self.items.append (item)
+            k()
+        else:
+            self.putters.append ((k, item, scheduler.current))
+
+    def cps_get (self, k):
+        if self.items:
+            item = self.items.popleft()
+            self._refill()
+            k (item)
+        elif _live (self.putters):
+            # unbuffered (capacity 0): take it straight from the producer
+            pk, item, tok = self.putters.popleft()
+            schedule_in (tok, pk)
+            k (item)
+        else:
+            self.getters.append ((k, scheduler.current))
+
+    def cps_get_many (self, k, n):
+        if not self.items and not _live (self.putters):
+            self.getters.append ((lambda item: self._get_more (k, n, item), scheduler.current))
+            return
+        batch = []
+        while len (batch) < n and (self.items or _live (self.putters)):
+            if self.items:
+                batch.append (self.items.popleft())
+                self._refill()
+            else:
+                pk, item, tok = self.putters.popleft()
+                schedule_in (tok, pk)
+                batch.append (item)
+        k (batch)
+
+    def _get_more (self, k, n, item):
+        # woken with one item: take whatever else is ready, up to <n>.
+        batch = [item]
+        while len (batch) < n and self.items:
+            batch.append (self.items.popleft())
+        self._refill()
+        k (batch)
+
+def cps_channel (k, capacity=1):
+    "CPS primitive: make a channel holding up to <capacity> items"
+    k (channel (capacity))
@@ -0,0 +1,218 @@
+# -*- Mode: Python -*-
+
+# generator backend: each cps_ function becomes a python generator.
+#
+# The closure-based output allocates a continuation function (kfN) at
+#   every point where a cps_ function may suspend.  A generator frame
+#   suspends and resumes as often as it likes without allocating anything,
+#   so this backend leaves the code in direct style and only rewrites the
+#   calls:
+#
+#   * a cps_ function defined in the file becomes the generator function
+#     gen_cps_f, and a call to one becomes (yield gen_cps_f (args)): it
+#     yields the callee's generator, and gets back the value it returns.
+#     A thin cps_f (k, *args) wrapper is kept for other callers (e.g.
+#     schedule (cps_f, k, ...)), so the two kinds of code mix freely.
+#   * a call to any other cps_ function - a @cps_manual primitive, a
+#     method, or one imported from elsewhere - becomes
+#     (yield (cps_f, (args,))): the driver calls cps_f (k, args...), and
+#     sends back whatever is passed to k.  So the primitives are the same
+#     ones the other backends use.
+#   * module-level code from the first statement that calls a cps_
+#     function on becomes a generator of its own, with the names it
+#     binds declared global, and is started under scheduler.run().
+#
+# scheduler.cps_generator() is the driver: it keeps the chain of callers
+#   as an explicit stack of generators, and steps the top one, so neither
+#   calls nor returns bounce through the scheduler's queue, and deep
+#   recursion never touches the python stack.  It does go back to the
+#   queue every scheduler.generator_slice steps, so a long computation
+#   doesn't starve other tasks.
+#
+# Since no continuations are made, anything python allows in a function
+#   works here - 'for', 'try', subscripts and all.  What doesn't is a
+#   cps_ call inside a nested non-cps_ function, lambda or comprehension.
+
+import ast
+import sys
+
+import unparse
+
+cps_prefix = 'cps_'
+
+def is_manual (node):
+    for dec in node.decorator_list:
+        if isinstance (dec, ast.Name) and dec.id == 'cps_manual':
+            return True
+    return False
+
+def cps_name (func):
+    "the name of the cps_ function called through <func>, or None"
+    if isinstance (func, ast.Name):
+        name = func.id
+    elif isinstance (func, ast.Attribute):
+        name = func.attr
+    else:
+        return None
+    if name.startswith (cps_prefix):
+        return name
+    return None
+
+def calls_cps (node):
+    for sub in ast.walk (node):
+        if isinstance (sub, ast.Call) and cps_name (sub.func) is not None:
+            return True
+    return False
+
+def bound_names (body):
+    "names bound by the statements in <body>, outside any nested scope"
+    names = set()
+    def visit (node):
+        if isinstance (node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add (node.name)
+            for dec in node.decorator_list:
+                visit (dec)
+            return
+        if isinstance (node, ast.Lambda):
+            return
+        if isinstance (node, ast.Name) and isinstance (node.ctx, ast.Store):
+            names.add (node.id)
+        elif isinstance (node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add ((alias.asname or alias.name).split ('.')[0])
+        for sub in ast.iter_child_nodes (node):
+            visit (sub)
+    for stmt in body:
+        visit (stmt)
+    return names
+
+class generator_calls (ast.NodeTransformer):
+
+    # rewrites the cps_ calls in one generator's body.  <generators> are
+    #   the names of the cps_ functions that are generators.
+
+    def __init__ (self, generators):
+        self.generators = generators
+
+    def visit_Call (self, node):
+        self.generic_visit (node)
+        name = cps_name (node.func)
+        if name is None:
+            return node
+        if isinstance (node.func, ast.Name) and name in self.generators:
+            # (yield gen_cps_f (args))
+            node.func = ast.copy_location (ast.Name (generator_name (name), ast.Load()), node.func)
+            request = node
+        else:
+            # (yield (cps_f, (args,)))
+            request = ast.Tuple ([node.func, ast.Tuple (node.args, ast.Load())], ast.Load())
+        return ast.copy_location (ast.Yield (request), node)
+
+    # a nested scope has its own meaning for yield; leave it alone.
+    def visit_Lambda (self, node):
+        return node
+
+    def visit_ClassDef (self, node):
+        return node
+
+    def visit_FunctionDef (self, node):
+        return node
+
+def generator_name (name):
+    return 'gen_' + name
+
+def generator_function (node, generators):
+    "convert the cps_ function <node> into a generator function"
+    node.name = generator_name (node.name)
+    node.body = [ generator_calls (generators).visit (stmt) for stmt in node.body ]
+    for sub in ast.walk (ast.Module (node.body, [])):
+        if isinstance (sub, (ast.Yield, ast.YieldFrom)):
+            break
+    else:
+        # it never calls anything, but the driver still needs a generator.
+        node.body[:0] = ast.parse ('if 0: yield').body
+    return node
+
+class converter:
+
+    main_name = 'cps_module'
+
+    def convert (self, tree):
+        "convert the module <tree> in place, and return it"
+        generators = set()
+        for stmt in tree.body:
+            if (isinstance (stmt, ast.FunctionDef)
+                and stmt.name.startswith (cps_prefix)
+                and not is_manual (stmt)):
+                generators.add (stmt.name)
+        body = []
+        main = None
+        for stmt in tree.body:
+            if isinstance (stmt, ast.FunctionDef) and stmt.name in generators:
+                # def gen_cps_f (x): <body, yielding calls>
+                # def cps_f (k, *args, **kwargs): cps_generator (k, gen_cps_f (*args, **kwargs))
+                wrapper = ast.parse (
+                    'def {0} (k, *args, **kwargs): cps_generator (k, {1} (*args, **kwargs))'.format (
+                        stmt.name, generator_name (stmt.name)
+                        )
+                    ).body[0]
+                stmt = [generator_function (stmt, generators), wrapper]
+            elif isinstance (stmt, ast.FunctionDef) and is_manual (stmt):
+                stmt.decorator_list = [ dec for dec in stmt.decorator_list if not (isinstance (dec, ast.Name) and dec.id == 'cps_manual') ]
+            elif main is None and calls_cps (stmt):
+                main = []
+            if not isinstance (stmt, list):
+                stmt = [stmt]
+            if main is None:
+                body.extend (stmt)
+            else:
+                main.extend (stmt)
+        if main is not None:
+            # def gen_cps_module():
+            #     global <names>
+            #     <the rest of the module>
+            # schedule (cps_generator, done, gen_cps_module())
+            names = sorted (bound_names (main))
+            fun, start = ast.parse (
+                'def {0}(): pass\n'
+                'schedule (cps_generator, lambda *result: None, {1}())\n'.format (self.main_name, generator_name (self.main_name))
+                ).body
+            fun.body = ([ast.Global (names)] if names else []) + main
+            body.append (generator_function (fun, generators))
+            body.append (start)
+        tree.body = body
+        return tree
+
+def convert (path):
+    "convert the file at <path>, returning the module's AST"
+    src = open (path).read()
+    return converter().convert (ast.parse (src, path, 'exec'))
+
+def unparse_module (tree):
+    # our unparse.py predates 'try' and friends, which generators can use.
+    if hasattr (ast, 'unparse'):
+        return ast.unparse (tree) + '\n'
+    else:
+        return unparse.Unparser (tree, None).getvalue()
+
+def dofile (path, runtime='scheduler'):
+    import os
+    src = unparse_module (convert (path))
+    base, ext = os.path.splitext (path)
+    fout = open (base + '.cps.py', 'wb')
+    fout.write (bytes ('\nfrom %s import schedule, cps_generator, run\n\n' % (runtime,), 'utf-8'))
+    fout.write (bytes (src, 'utf-8'))
+    fout.write (b'\nrun()\n')
+    fout.close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    runtime = 'scheduler'
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg.startswith ('--runtime='):
+            runtime = arg[len('--runtime='):]
+        else:
+            raise ValueError (arg)
+    for path in args:
+        dofile (path, runtime)
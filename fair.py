@@ -0,0 +1,100 @@
+# -*- Mode: Python -*-
+
+# a fair-share scheduler, with the same schedule/run interface as
+#   scheduler.py (convert with 'trampoline.py --runtime=fair').
+#
+# scheduler.py is strict FIFO, so a task tree that bounces in a tight loop
+#   gets a turn for every bounce and can starve everything else.  Here
+#   every task tree belongs to a group: spawn() starts a new tree in a
+#   group of its own, and anything scheduled while one of its continuations
+#   is running stays in that group.  Each group has a weight (its priority)
+#   and a quantum.  The run loop does weighted fair queueing over groups:
+#   it picks the runnable group that has had the least CPU time divided by
+#   weight, runs its continuations until the quantum is used up or it has
+#   nothing left to run, and charges it for the time spent.
+
+import heapq
+import time
+from collections import deque
+
+class group:
+
+    def __init__ (self, name=None, weight=1, quantum=0.002):
+        self.name = name
+        self.weight = weight
+        self.quantum = quantum
+        self.tasks = deque()
+        # weighted CPU time: the key we queue on.
+        self.vtime = 0.0
+        # stats
+        self.cpu = 0.0
+        self.ran = 0
+        self.queued = False
+
+    def __repr__ (self):
+        return '<group %s weight=%r cpu=%.6f ran=%d>' % (self.name, self.weight, self.cpu, self.ran)
+
+# the group whose continuation is running; new tasks go to it.
+default_group = group ('default')
+current = default_group
+
+# runnable groups, as (vtime, seq, group)
+_ready = []
+_seq = 0
+# the virtual time of the group that ran last; a newly runnable group starts
+#   here, so it can't claim credit for time spent idle.
+_vclock = 0.0
+
+def _enqueue (g):
+    global _seq
+    if g.vtime < _vclock:
+        g.vtime = _vclock
+    g.queued = True
+    _seq += 1
+    heapq.heappush (_ready, (g.vtime, _seq, g))
+
+def schedule (fun, *args):
+    g = current
+    g.tasks.append ((fun, args))
+    if not g.queued:
+        _enqueue (g)
+
+# the fixed-arity entry points that trampoline output calls.
+schedule0 = schedule1 = schedule2 = schedule
+
+def schedule_in (g, fun, *args):
+    "schedule a task in a particular group, e.g. to wake a task parked by another tree"
+    g.tasks.append ((fun, args))
+    if not g.queued:
+        _enqueue (g)
+
+def spawn (fun, *args, name=None, weight=1, quantum=0.002):
+    "start a new task tree: run fun(*args) in a group of its own"
+    g = group (name, weight, quantum)
+    schedule_in (g, fun, *args)
+    return g
+
+def run (clock=time.perf_counter):
+    global current, _vclock
+    while _ready:
+        # g stays marked as queued while it runs, so that schedule()
+        #   doesn't push it again before it has been charged.
+        vtime, seq, g = heapq.heappop (_ready)
+        _vclock = vtime
+        current = g
+        tasks = g.tasks
+        spent = 0.0
+        t0 = clock()
+        while tasks and spent < g.quantum:
+            fun, args = tasks.popleft()
+            fun (*args)
+            t1 = clock()
+            spent += t1 - t0
+            t0 = t1
+            g.ran += 1
+        g.cpu += spent
+        g.vtime += spent / g.weight
+        current = default_group
+        g.queued = False
+        if tasks:
+            _enqueue (g)
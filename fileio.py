@@ -0,0 +1,195 @@
+# -*- Mode: Python -*-
+
+# streaming file input for CPS code, without blocking the scheduler.
+#
+# cps_read_chunks (path, size, ahead) opens <path> and continues with a
+#   chunk_reader.  A helper thread reads <size>-byte chunks ahead of the
+#   consumer, keeping at most <ahead> of them buffered; reader.cps_read()
+#   continues with the next one (b'' at EOF), straight away if it's
+#   already been read, or when the thread has it.
+#
+#   from fileio import cps_read_chunks
+#
+#   def cps_count (path):
+#       chunks = cps_read_chunks (path, 1048576, 4)
+#       total = 0
+#       chunk = chunks.cps_read ()
+#       while chunk:
+#           total = total + len (chunk)
+#           chunk = chunks.cps_read ()
+#       else:
+#           chunks.close ()
+#       return total
+#
+# cps_lines (path, batch) maps <path> and continues with a line_reader,
+#   whose cps_read() continues with a list of up to <batch> lines at a
+#   time (an empty list at EOF), each a memoryview of the map without its
+#   newline, so nothing is copied.  Before handing over a batch it asks
+#   the kernel to page in the next <ahead> bytes, so the scheduler thread
+#   rarely waits on the disk, and other tasks run between batches.  The
+#   views are only good until close(): keep bytes (line) if you need one
+#   longer.
+
+import mmap
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+from scheduler import cps_run_in_thread, cps_wait_future
+
+class chunk_reader:
+
+    def __init__ (self, file, size=1048576, ahead=4):
+        self.file = file
+        self.size = size
+        # chunks read ahead, and an error from the thread
+        self.chunks = deque()
+        self.error = None
+        # set once b'' has been handed to the consumer: the thread has stopped.
+        self.eof = False
+        # the consumer's future, when it's waiting for the thread
+        self.waiter = None
+        self.lock = threading.Lock()
+        # one per buffer the thread may fill
+        self.room = threading.Semaphore (ahead)
+        self.closed = False
+        self.thread = threading.Thread (target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def __repr__ (self):
+        return '<chunk_reader %r buffered=%d>' % (self.file.name, len (self.chunks))
+
+    def _read_ahead (self):
+        # the helper thread
+        try:
+            while 1:
+                self.room.acquire()
+                if self.closed:
+                    break
+                try:
+                    chunk = self.file.read (self.size)
+                except Exception as e:
+                    chunk = None
+                    error = e
+                with self.lock:
+                    waiter, self.waiter = self.waiter, None
+                    if chunk is None:
+                        self.error = error
+                    elif waiter is None:
+                        self.chunks.append (chunk)
+                    elif not chunk:
+                        self.eof = True
+                if waiter is not None:
+                    try:
+                        if chunk is None:
+                            waiter.set_exception (error)
+                        else:
+                            waiter.set_result (chunk)
+                    except InvalidStateError:
+                        # the consumer's task tree was cancelled
+                        pass
+                if not chunk:
+                    break
+        finally:
+            self.file.close()
+
+    def cps_read (self, k):
+        "CPS primitive: continue with the next chunk, b'' at EOF"
+        with self.lock:
+            if self.eof:
+                chunk = b''
+            elif self.chunks:
+                chunk = self.chunks.popleft()
+                if not chunk:
+                    self.eof = True
+            elif self.error is not None:
+                raise self.error
+            else:
+                self.waiter = Future()
+                chunk = None
+        if chunk is None:
+            # the thread hands it straight to the waiter, without buffering it.
+            self.room.release()
+            cps_wait_future (k, self.waiter)
+        else:
+            if chunk:
+                self.room.release()
+            k (chunk)
+
+    def close (self):
+        self.closed = True
+        # wake the thread if it's waiting for room.
+        self.room.release()
+
+def _open_chunks (path, size, ahead):
+    return chunk_reader (open (path, 'rb', buffering=0), size, ahead)
+
+def cps_read_chunks (k, path, size=1048576, ahead=4):
+    "CPS primitive: open <path> and continue with a chunk_reader for it"
+    cps_run_in_thread (k, _open_chunks, path, size, ahead)
+
+class line_reader:
+
+    def __init__ (self, file, batch=4096, ahead=8388608):
+        self.batch = batch
+        self.ahead = ahead
+        self.pos = 0
+        # advised up to here
+        self.advised = 0
+        try:
+            self.map = mmap.mmap (file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            self.map = b''
+        file.close()
+        self.size = len (self.map)
+        self.view = memoryview (self.map)
+        if self.size and hasattr (mmap, 'MADV_SEQUENTIAL'):
+            self.map.madvise (mmap.MADV_SEQUENTIAL)
+
+    def __repr__ (self):
+        return '<line_reader %d/%d>' % (self.pos, self.size)
+
+    def _advise (self):
+        # page in the next <ahead> bytes in the background.
+        end = min (self.size, self.pos + self.ahead)
+        if end > self.advised and hasattr (mmap, 'MADV_WILLNEED'):
+            start = self.advised - self.advised % mmap.PAGESIZE
+            self.map.madvise (mmap.MADV_WILLNEED, start, end - start)
+            self.advised = end
+
+    def cps_read (self, k):
+        "CPS primitive: continue with a list of up to <batch> lines, [] at EOF"
+        view = self.view
+        find = self.map.find
+        size = self.size
+        pos = self.pos
+        lines = []
+        for i in range (self.batch):
+            if pos >= size:
+                break
+            end = find (b'\n', pos)
+            if end < 0:
+                end = size
+            lines.append (view[pos:end])
+            pos = end + 1
+        self.pos = pos
+        if self.size:
+            self._advise()
+        k (lines)
+
+    def close (self):
+        self.view.release()
+        if self.size:
+            try:
+                self.map.close()
+            except BufferError:
+                # lines are still held: the map goes when they do.
+                pass
+
+def _open_lines (path, batch, ahead):
+    return line_reader (open (path, 'rb'), batch, ahead)
+
+def cps_lines (k, path, batch=4096, ahead=8388608):
+    "CPS primitive: map <path> and continue with a line_reader for it"
+    cps_run_in_thread (k, _open_lines, path, batch, ahead)
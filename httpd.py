@@ -0,0 +1,181 @@
+# -*- Mode: Python -*-
+
+# a small keep-alive, pipelining HTTP/1.1 server, and a load generator to
+#   drive it, written as cps_ code for trampoline.py.  bench_http.py
+#   converts this file and runs the two against each other over loopback.
+#
+# the cps_ functions only move bytes; parsing and stats are plain python.
+#   The server answers every request with a short fixed body, except for
+#   GET /stats, which reports the scheduler's bounce count and the number
+#   of requests served (so a client can work out bounces per request).
+
+import socket
+import time
+import scheduler
+from scheduler import cps_accept, cps_connect, cps_recv, cps_sendall
+
+def done (*args):
+    pass
+
+def listener (port=0, backlog=4096):
+    s = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind (('127.0.0.1', port))
+    s.listen (backlog)
+    s.setblocking (False)
+    return s
+
+def nodelay (sock):
+    sock.setsockopt (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+# requests served, by all connections
+served = 0
+
+def response (body):
+    return b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n%s' % (len (body), body)
+
+RESPONSE = response (b'Hello, World!\n')
+
+def _content_length (head):
+    for line in head.split (b'\r\n')[1:]:
+        name, _, value = line.partition (b':')
+        if name.strip().lower() == b'content-length':
+            return int (value)
+    return 0
+
+class http_connection:
+
+    "the server's parser: feed() takes bytes as they arrive, and returns the replies they complete"
+
+    def __init__ (self):
+        self.buffer = b''
+        self.closing = False
+
+    def _keep_alive (self, head):
+        version = head.split (b'\r\n', 1)[0].rsplit (b' ', 1)[-1]
+        connection = b''
+        for line in head.split (b'\r\n')[1:]:
+            name, _, value = line.partition (b':')
+            if name.strip().lower() == b'connection':
+                connection = value.strip().lower()
+        if version == b'HTTP/1.1':
+            return connection != b'close'
+        else:
+            return connection == b'keep-alive'
+
+    def _reply (self, head):
+        global served
+        served += 1
+        if head.startswith (b'GET /stats '):
+            return response (b'%d %d\n' % (scheduler.bounces, served))
+        else:
+            return RESPONSE
+
+    def feed (self, data):
+        buf = self.buffer + data
+        replies = []
+        pos = 0
+        while not self.closing:
+            i = buf.find (b'\r\n\r\n', pos)
+            if i < 0:
+                break
+            head = buf[pos:i]
+            end = i + 4 + _content_length (head)
+            if end > len (buf):
+                break
+            replies.append (self._reply (head))
+            if not self._keep_alive (head):
+                self.closing = True
+            pos = end
+        self.buffer = buf[pos:]
+        return b''.join (replies)
+
+def cps_serve_connection (sock):
+    conn = http_connection()
+    data = cps_recv (sock, 65536)
+    while data:
+        cps_sendall (sock, conn.feed (data))
+        if conn.closing:
+            data = b''
+        else:
+            data = cps_recv (sock, 65536)
+    else:
+        sock.close()
+    return 0
+
+def cps_serve (lsock):
+    sock = cps_accept (lsock)
+    while sock:
+        schedule (cps_serve_connection, done, nodelay (sock))
+        sock = cps_accept (lsock)
+    else:
+        lsock.close()
+    return 0
+
+# the load generator.  Each client sends <depth> pipelined requests at a
+#   time, and waits for all their replies before sending more; a reply's
+#   latency is from the send of its batch to the end of its body.
+
+REQUEST = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+
+class latencies:
+
+    def __init__ (self):
+        self.samples = []
+
+    def percentile (self, p):
+        xs = sorted (self.samples)
+        if not xs:
+            return 0.0
+        return xs[min (len (xs) - 1, int (len (xs) * p))]
+
+class http_client:
+
+    "one client connection's state: what to send next, and the parser for replies"
+
+    def __init__ (self, requests, depth, stats):
+        self.remaining = requests
+        self.depth = depth
+        self.stats = stats
+        self.waiting = 0
+        self.buffer = b''
+        self.sent = 0.0
+
+    def running (self):
+        return self.remaining or self.waiting
+
+    def next_batch (self):
+        n = min (self.depth, self.remaining)
+        self.remaining -= n
+        self.waiting = n
+        self.sent = time.perf_counter()
+        return REQUEST * n
+
+    def feed (self, data):
+        if not data:
+            raise ConnectionError ('server closed the connection')
+        buf = self.buffer + data
+        pos = 0
+        while self.waiting:
+            i = buf.find (b'\r\n\r\n', pos)
+            if i < 0:
+                break
+            end = i + 4 + _content_length (buf[pos:i])
+            if end > len (buf):
+                break
+            self.stats.samples.append (time.perf_counter() - self.sent)
+            self.waiting -= 1
+            pos = end
+        self.buffer = buf[pos:]
+
+def cps_client (address, c):
+    sock = nodelay (cps_connect (address))
+    while c.running():
+        if c.waiting:
+            c.feed (cps_recv (sock, 65536))
+        else:
+            cps_sendall (sock, c.next_batch())
+    else:
+        sock.close()
+    return 0
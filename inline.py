@@ -0,0 +1,25 @@
+# -*- Mode: Python -*-
+
+# an example for --inline: cps_h rebinds its parameter after a cps_ call,
+#   so it can be inlined into cps_outer, but not at module level, where
+#   the assignment would land in a module-level continuation.
+#   prints 8, then 9.
+
+@cps_manual
+def cps_print (k, v):
+    print (v)
+    k()
+
+def cps_id (x):
+    return x
+
+def cps_h (y):
+    if y > 0:
+        y = y + cps_id (5)
+    return y
+
+def cps_outer (z):
+    return 1 + cps_h (z)
+
+cps_print (cps_h (3))
+cps_print (cps_outer (3))
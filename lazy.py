@@ -0,0 +1,188 @@
+# -*- Mode: Python -*-
+
+# convert cps_ functions one at a time, on their first call, rather than
+#   a whole file up front.
+#
+#   from lazy import cps
+#
+#   @cps
+#   def cps_fetch (url):
+#       ...
+#
+# the decorated function stays as plain python source until something
+#   calls it (with a continuation as the first argument, like any other
+#   converted cps_ function).  The first call gets its source, converts it
+#   with trampoline.py's transformer and compiles it in the function's
+#   module, where the new function replaces the decorator's wrapper; the
+#   call then goes through.  A process that only ever uses a few functions
+#   of a large CPS code base only pays for those.
+#
+# the compiled code is also written to __pycache__ next to the source
+#   file, keyed by a hash of the function's source, the options, the
+#   transformer and the python version, so the next process just loads it.
+#   Set lazy.cache_dir to put it elsewhere, or to None to keep nothing on
+#   disk.
+#
+# only module-level functions can be converted this way (the source of a
+#   nested one can't be compiled without its enclosing scope), and @cps
+#   must be the only decorator.  the generated code calls 'schedule' (and
+#   schedule0/1/2): any of them the module doesn't define are taken from
+#   <runtime>.
+#
+# options are passed on to the transformer: @cps (optimize=True),
+#   @cps (runtime='fair').  The transformer only sees the one function, so
+#   with dual=True it can only go direct if its only cps_ calls are to
+#   itself (cps_fib, say); with inline=True, the candidates are taken from
+#   the whole module's source, which is then part of the cache key.
+
+import ast
+import hashlib
+import importlib
+import inspect
+import io
+import marshal
+import os
+import sys
+import textwrap
+
+import transform
+import trampoline
+
+# where to keep compiled code: '__pycache__' means next to each source
+#   file, None means don't.
+cache_dir = '__pycache__'
+
+_version = None
+
+def _transformer_version():
+    # the converter itself is part of the cache key.
+    global _version
+    if _version is None:
+        h = hashlib.sha1()
+        for module in (transform, trampoline, sys.modules[__name__]):
+            with open (module.__file__, 'rb') as f:
+                h.update (f.read())
+        _version = h.hexdigest()
+    return _version
+
+def _is_cps_decorator (dec):
+    if isinstance (dec, ast.Call):
+        dec = dec.func
+    return ((isinstance (dec, ast.Name) and dec.id == 'cps')
+            or (isinstance (dec, ast.Attribute) and dec.attr == 'cps'))
+
+def _parse (fun):
+    # (module, def) for <fun>, with @cps checked and taken off
+    src = textwrap.dedent (inspect.getsource (fun))
+    tree = ast.parse (src)
+    node = tree.body[0]
+    if not isinstance (node, ast.FunctionDef) or not all (_is_cps_decorator (d) for d in node.decorator_list):
+        raise TypeError ('@cps must be the only decorator of %s' % (fun.__qualname__,))
+    node.decorator_list = []
+    return tree, node
+
+def _def_lineno (fun):
+    # the line of the def itself in its file: co_firstlineno is the first
+    #   decorator's.
+    tree, node = _parse (fun)
+    return fun.__code__.co_firstlineno + node.lineno - 1
+
+def convert (fun, optimize=False, **options):
+    "return the converted source of the module-level function <fun>"
+    tree, node = _parse (fun)
+    t = trampoline.trampoline (**options)
+    # the analyses t_Module would have run, for what we can see.
+    if t.dual:
+        t.never_suspend = t.find_never_suspend ([node])
+    if t.inline:
+        t.functions = t.find_inlinable (ast.parse (inspect.getsource (sys.modules[fun.__module__])).body)
+    out = io.BytesIO()
+    transform.transform_body (tree.body, t, optimize).emit_all (transform.writer (out))
+    return out.getvalue().decode ('utf-8')
+
+class cps:
+
+    def __init__ (self, fun=None, runtime='scheduler', **options):
+        self.runtime = runtime
+        self.options = options
+        self.fun = None
+        if fun is not None:
+            self.wrap (fun)
+
+    def wrap (self, fun):
+        if not fun.__name__.startswith ('cps_'):
+            raise TypeError ('@cps function names must start with cps_: %s' % (fun.__qualname__,))
+        if fun.__code__.co_freevars or '<locals>' in fun.__qualname__:
+            raise TypeError ('@cps only works on module-level functions: %s' % (fun.__qualname__,))
+        self.fun = fun
+        self.compiled = None
+        self.__name__ = fun.__name__
+        self.__qualname__ = fun.__qualname__
+        self.__module__ = fun.__module__
+        self.__doc__ = fun.__doc__
+        self.__wrapped__ = fun
+
+    def __repr__ (self):
+        return '<cps %s%s>' % (self.__qualname__, '' if self.compiled else ' (not converted)')
+
+    def __call__ (self, *args, **kwargs):
+        if self.fun is None:
+            # @cps (options...): we're being applied to the function.
+            self.wrap (*args)
+            return self
+        if self.compiled is None:
+            self.compile()
+        return self.compiled (*args, **kwargs)
+
+    def cache_path (self, key):
+        if cache_dir is None:
+            return None
+        path = self.fun.__code__.co_filename
+        if cache_dir == '__pycache__':
+            where = os.path.join (os.path.dirname (os.path.abspath (path)), '__pycache__')
+        else:
+            where = cache_dir
+        base = os.path.splitext (os.path.basename (path))[0]
+        return os.path.join (where, '%s.%s.%s.cps.%s' % (base, self.__name__, key[:16], sys.implementation.cache_tag))
+
+    def compile (self):
+        fun = self.fun
+        g = fun.__globals__
+        raw = inspect.getsource (fun)
+        if self.options.get ('inline'):
+            # what gets inlined comes from anywhere in the module.
+            raw = inspect.getsource (sys.modules[fun.__module__])
+        lineno = _def_lineno (fun)
+        key = hashlib.sha1 (repr ((raw, lineno, self.runtime, sorted (self.options.items()), _transformer_version())).encode ('utf-8')).hexdigest()
+        path = self.cache_path (key)
+        code = None
+        if path is not None:
+            try:
+                with open (path, 'rb') as f:
+                    code = marshal.load (f)
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        if code is None:
+            tree = ast.parse (convert (fun, **self.options), fun.__code__.co_filename)
+            # so tracebacks point into the file, not at line 1.
+            ast.increment_lineno (tree, lineno - tree.body[0].lineno)
+            code = compile (tree, fun.__code__.co_filename, 'exec')
+            if path is not None:
+                try:
+                    os.makedirs (os.path.dirname (path), exist_ok=True)
+                    tmp = '%s.%d' % (path, os.getpid())
+                    with open (tmp, 'wb') as f:
+                        marshal.dump (code, f)
+                    os.replace (tmp, path)
+                except OSError:
+                    pass
+        # one at a time: the module may have imported just 'schedule'.
+        missing = [ name for name in ('schedule', 'schedule0', 'schedule1', 'schedule2') if name not in g ]
+        if missing:
+            runtime = importlib.import_module (self.runtime)
+            for name in missing:
+                g[name] = getattr (runtime, name)
+        # the def lands in the module's namespace, replacing this wrapper
+        #   for everything that looks it up by name from now on.
+        exec (code, g)
+        self.compiled = g[self.__name__]
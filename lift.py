@@ -0,0 +1,162 @@
+# -*- Mode: Python -*-
+
+# lambda-lifted trampoline output: continuations become picklable records.
+#
+# The closures generated by the normal transform (the nested 'def kfN')
+#   cannot be pickled, so a suspended computation can't be checkpointed
+#   or moved to another process.  This variant does closure conversion
+#   on the CPS tree:
+#
+#   * each real cps_ function allocates a scheduler.Frame on entry, and
+#     all of its locals, temporaries, continuation arguments and
+#     continuation functions live in that frame ('env.x' rather than 'x').
+#   * every continuation function is hoisted to module level, taking the
+#     frame as an extra first argument, and is passed around as a
+#     scheduler.Closure (module-level function + frame).
+#   * module-level code gets a frame of its own for its temporaries;
+#     names assigned by the user at module level stay globals.
+#
+# Since a Closure pickles as a reference to its function plus the frame,
+#   anything sitting in the scheduler's queue can be written out with
+#   scheduler.dump() and picked up again by scheduler.load() in another
+#   process running the same module.
+
+import ast
+import io
+import sys
+from transform import *
+from trampoline import trampoline
+
+class FrameDef (FunctionDef):
+
+    # a real cps_ function: its locals live in a Frame.
+    def emit (self, out):
+        name, kfunp, decs, nonlocals, yeslocals, formals = self.params
+        names = [ x.arg for x in formals.args ]
+        out ('def %s (%s):' % (name, ', '.join (names)))
+        out.indent()
+        out ('env = Frame()')
+        for x in names:
+            out ('env.%s = %s' % (x, x))
+        self.subs[0].emit_all (out)
+        out.dedent()
+
+class ClosureDef (FunctionDef):
+
+    # names assigned at module level from inside this continuation.
+    globals = ()
+
+    # in place, a continuation is just a record of (function, frame)...
+    def emit (self, out):
+        out ('env.%s = Closure (%s, env)' % (self.name, self.name))
+        out.hoist (self)
+
+    # ... and the function itself is emitted at module level.
+    def emit_lifted (self, out):
+        name, kfunp, decs, nonlocals, yeslocals, formals = self.params
+        names = [ x.arg for x in formals.args ]
+        out ('def %s (%s):' % (name, ', '.join (['env'] + names)))
+        out.indent()
+        if self.globals:
+            out ('global %s' % (', '.join (sorted (self.globals)),))
+        for x in names:
+            out ('env.%s = %s' % (x, x))
+        self.subs[0].emit_all (out)
+        out.dedent()
+
+class lifter (trampoline):
+
+    def make_function (self, name, kfunp, args, decorator_list, body, k):
+        if kfunp:
+            return ClosureDef (name, kfunp, args, decorator_list, body, k)
+        else:
+            return FrameDef (name, kfunp, args, decorator_list, body, k)
+
+# all the nodes belonging to one frame: descends into continuation
+#   functions, but not into real functions (they have their own frame).
+def scope_nodes (root, into_closures=True):
+    for node in walk (root):
+        yield node
+        if isinstance (node, FunctionDef) and (not node.kfunp or not into_closures):
+            continue
+        for sub in node.subs:
+            if sub:
+                yield from scope_nodes (sub, into_closures)
+
+def lift_closures (root, fun=None):
+    # 1) find the names that live in this frame
+    names = set()
+    if fun is not None:
+        names.update (fun.yeslocals)
+        names.update (x.arg for x in fun.formals.args)
+    nodes = list (scope_nodes (root))
+    for node in nodes:
+        if node.k.name not in ('', '_'):
+            names.add (node.k.name)
+        if isinstance (node, FunctionDef):
+            if node.kfunp:
+                names.add (node.name)
+                names.update (x.arg for x in node.formals.args)
+            else:
+                lift_closures (node.subs[0], node)
+    # 2) rewrite references to them as frame slots
+    def ref (name):
+        if name in names:
+            return 'env.' + name
+        else:
+            return name
+    for node in nodes:
+        node.vars = [ ref (v) for v in node.vars ]
+        if node.k.name in names:
+            node.k.name = ref (node.k.name)
+        if isinstance (node, Name) and node.params.id in names:
+            node.params = ast.Name (ref (node.params.id), ast.Load())
+        elif isinstance (node, Assign) and isinstance (node.params, ast.Name) and node.params.id in names:
+            node.params = ast.Attribute (ast.Name ('env', ast.Load()), node.params.id, ast.Store())
+    # 3) a hoisted continuation that assigns a module-level name needs a 'global'
+    if fun is None:
+        for node in nodes:
+            if isinstance (node, ClosureDef):
+                node.globals = set (
+                    n.params.id for n in scope_nodes (node.subs[0], False)
+                    if isinstance (n, Assign) and isinstance (n.params, ast.Name)
+                    )
+
+class lift_writer (writer):
+    def __init__ (self, fout, hoisted):
+        writer.__init__ (self, fout)
+        self.hoisted = hoisted
+    def hoist (self, node):
+        self.hoisted.append (node)
+
+def dofile (path, **options):
+    import os
+    cps = transform (path, lifter, **options)
+    lift_closures (cps)
+    hoisted = []
+    body = io.BytesIO()
+    w = lift_writer (body, hoisted)
+    w ('env = Frame()')
+    cps.emit_all (w)
+    base, ext = os.path.splitext (path)
+    fout = open (base + '.cps.py', 'wb')
+    fout.write (b'\nfrom scheduler import schedule, schedule0, schedule1, schedule2, run, Frame, Closure\n\n')
+    # continuation functions first, so they exist before module-level code runs.
+    #   (emitting one may hoist more, nested inside it)
+    w = lift_writer (fout, hoisted)
+    while hoisted:
+        hoisted.pop(0).emit_lifted (w)
+    fout.write (body.getvalue())
+    fout.write (b'\nrun()\n')
+    fout.close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {}
+    while args and args[0] in ('-O', '--inline'):
+        if args.pop (0) == '-O':
+            options['optimize'] = True
+        else:
+            options['inline'] = True
+    for path in args:
+        dofile (path, **options)
@@ -0,0 +1,24 @@
+# -*- Mode: Python -*-
+
+import functools
+
+@cps_manual
+def cps_print (k, v):
+    print (v)
+    k()
+
+@functools.lru_cache (None)
+def double (x):
+    return x * 2
+
+scale = 3
+
+def cps_scaled (x):
+    return double (x) * scale
+
+cps_print (cps_scaled (4))
+
+def cps_after (x):
+    return x + 1
+
+cps_print (cps_after (cps_scaled (1)))
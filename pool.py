@@ -0,0 +1,197 @@
+# -*- Mode: Python -*-
+
+# a pool of client connections, keyed by (host, port).
+#
+# cps_acquire hands out an idle connection for the address if there is a
+#   healthy one, opens a new one (on the thread pool, via
+#   scheduler.cps_run_in_thread) if the address has fewer than <max_size>,
+#   and otherwise parks the caller until one is released.  cps_release
+#   gives a connection straight to the oldest parked caller, or puts it
+#   back on the idle list.
+#
+#   from pool import cps_pool
+#
+#   def cps_fetch (p, req):
+#       conn = p.cps_acquire ('127.0.0.1', 8000)
+#       reply = cps_run_in_thread (talk, conn, req)
+#       p.cps_release (conn)
+#       return reply
+#
+# Connections idle for longer than <idle_timeout> are closed, and an idle
+#   connection is health-checked before it's handed out: if the server
+#   has closed it (or sent something nobody asked for) it's thrown away
+#   and the next one tried.  Both checks are made lazily at checkout;
+#   call prune() to close stale connections without waiting for one.
+#
+# A connection that the caller knows is broken should be released with
+#   reuse=False, which closes it and frees its slot.  Callers parked by a
+#   task tree that has since been cancelled are passed over.
+
+import socket
+import time
+from collections import deque
+import scheduler
+from scheduler import schedule_in, cps_run_in_thread
+
+def _healthy (sock):
+    # an idle connection should have nothing to read: EOF means the server
+    #   closed it, and unsolicited data means we'd be out of step.
+    timeout = sock.gettimeout()
+    sock.setblocking (False)
+    try:
+        sock.recv (1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout (timeout)
+    return False
+
+def _connect (connect, address):
+    # runs on the thread pool.  hand back the error rather than raising it,
+    #   so the scheduler side can give the slot back first.
+    try:
+        return connect (address), None
+    except OSError as e:
+        return None, e
+
+class _address:
+
+    def __init__ (self):
+        # (sock, time released), most recently used on the right.
+        self.idle = deque()
+        # (k, token) parked in cps_acquire
+        self.waiters = deque()
+        # connections open or being opened
+        self.size = 0
+
+class pool:
+
+    def __init__ (self, max_size=8, idle_timeout=30.0, connect=socket.create_connection, clock=time.monotonic):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect = connect
+        self.clock = clock
+        self.addresses = {}
+        # the address each connection we handed out belongs to
+        self.owner = {}
+        # stats
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def __repr__ (self):
+        return '<pool max_size=%d opened=%d reused=%d discarded=%d>' % (
+            self.max_size, self.opened, self.reused, self.discarded
+            )
+
+    def _next_waiter (self, a):
+        while a.waiters:
+            k, tok = a.waiters.popleft()
+            if tok is None or not tok.cancelled:
+                return k, tok
+        return None
+
+    def _get (self, address):
+        try:
+            return self.addresses[address]
+        except KeyError:
+            a = self.addresses[address] = _address()
+            return a
+
+    def _close (self, a, sock):
+        a.size -= 1
+        self.discarded += 1
+        sock.close()
+
+    def _expire (self, a, now):
+        while a.idle and now - a.idle[0][1] > self.idle_timeout:
+            sock, t = a.idle.popleft()
+            self._close (a, sock)
+
+    def prune (self):
+        "close every connection that has been idle for longer than idle_timeout"
+        now = self.clock()
+        for a in self.addresses.values():
+            self._expire (a, now)
+
+    def cps_acquire (self, k, host, port):
+        address = (host, port)
+        a = self._get (address)
+        self._expire (a, self.clock())
+        while a.idle:
+            sock, t = a.idle.pop()
+            if _healthy (sock):
+                self.reused += 1
+                self.owner[sock] = address
+                k (sock)
+                return
+            else:
+                self._close (a, sock)
+        if a.size < self.max_size:
+            self._open (k, scheduler.current, address, a)
+        else:
+            a.waiters.append ((k, scheduler.current))
+
+    def _open (self, k, tok, address, a):
+        a.size += 1
+        self.opened += 1
+        # the completion runs outside any task tree, so that the slot is
+        #   accounted for even if <tok> is cancelled in the meantime.
+        current, scheduler.current = scheduler.current, None
+        try:
+            cps_run_in_thread (
+                lambda r: self._opened (k, tok, address, a, r),
+                _connect, self.connect, address
+                )
+        finally:
+            scheduler.current = current
+
+    def _open_for_waiter (self, address, a):
+        w = self._next_waiter (a)
+        if w is not None:
+            self._open (w[0], w[1], address, a)
+
+    def _opened (self, k, tok, address, a, result):
+        sock, e = result
+        if e is not None:
+            a.size -= 1
+            # let the next caller in line try for itself.
+            self._open_for_waiter (address, a)
+            raise e
+        elif tok is not None and tok.cancelled:
+            self._put_back (sock, address, a)
+        else:
+            self.owner[sock] = address
+            schedule_in (tok, k, sock)
+
+    def _put_back (self, sock, address, a):
+        w = self._next_waiter (a)
+        if w is not None:
+            self.reused += 1
+            self.owner[sock] = address
+            schedule_in (w[1], w[0], sock)
+        else:
+            a.idle.append ((sock, self.clock()))
+
+    def cps_release (self, k, sock, reuse=True):
+        address = self.owner.pop (sock)
+        a = self.addresses[address]
+        if reuse:
+            self._put_back (sock, address, a)
+        else:
+            self._close (a, sock)
+            self._open_for_waiter (address, a)
+        k()
+
+    def close (self):
+        "close every idle connection"
+        for a in self.addresses.values():
+            while a.idle:
+                sock, t = a.idle.pop()
+                self._close (a, sock)
+
+def cps_pool (k, max_size=8, idle_timeout=30.0):
+    "CPS primitive: make a connection pool with up to <max_size> connections per address"
+    k (pool (max_size, idle_timeout))
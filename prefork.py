@@ -0,0 +1,347 @@
+# -*- Mode: Python -*-
+
+# a pre-forking launcher for CPS servers.  scheduler.py runs on one core,
+#   so a server scales by running one process per core: each worker runs
+#   its own scheduler loop, with its own SO_REUSEPORT listener on the same
+#   port, and the kernel spreads new connections across the listeners.
+#   The workers share nothing.
+#
+#   group = prefork (httpd.cps_serve, workers=4, address=('127.0.0.1', 8080))
+#   group.start()
+#   group.stats()       # each worker's stats, and their totals
+#   group.restart()     # replace the workers, one at a time
+#   group.stop()
+#
+# <serve> is a converted cps_ function taking the listener, like
+#   httpd.cps_serve: an accept loop that closes the listener and returns
+#   once cps_accept continues with None.
+#
+# the parent holds the port with a SO_REUSEPORT socket that is bound but
+#   never listens (so no connections go to it), and talks to each worker
+#   over a socketpair, its control pipe.  Commands are lines:
+#
+#   stats   the worker replies with a line of JSON: its pid, uptime,
+#           scheduler bounces and queue length, and whatever the
+#           launcher's <stats> function returns (e.g. requests served)
+#   stop    the worker stops accepting, taking the connections already
+#           queued on its listener (see scheduler.close_listener), and
+#           replies with its stats.  It exits when its open connections
+#           are done, or after <grace> seconds, and writes a last line of
+#           stats as it goes, which the parent reads when it reaps it
+#
+# restart() is graceful: each new worker is listening before the one it
+#   replaces is told to stop, so the port always has a listener, and no
+#   queued connection is reset.  Stopped workers' final stats are kept,
+#   so the totals carry over restarts (once the stopped workers have
+#   exited: until then, they count as of their reply to 'stop').
+#
+# python prefork.py [-O] [--workers=N] [--port=P] serves httpd.py:
+#   SIGHUP restarts the workers, SIGUSR1 prints their stats, SIGINT or
+#   SIGTERM stops them.  A worker that dies is replaced.
+
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import scheduler
+
+def done (*args):
+    pass
+
+def reuseport_socket():
+    s = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    return s
+
+def listener (address, backlog=4096):
+    "a non-blocking SO_REUSEPORT listener on <address>"
+    s = reuseport_socket()
+    s.bind (address)
+    s.listen (backlog)
+    s.setblocking (False)
+    return s
+
+def totals (reports):
+    "the sum of each number in <reports>, but for the ones that don't add up"
+    r = {}
+    for report in reports:
+        for key, value in report.items():
+            if key not in ('pid', 'uptime') and isinstance (value, (int, float)):
+                r[key] = r.get (key, 0) + value
+    return r
+
+class control_loop:
+
+    # the worker's end of the control pipe, served by a (hand-written)
+    #   cps_ loop in the worker's scheduler, next to the server.
+
+    def __init__ (self, control, lsock, stats, grace):
+        self.control = control
+        self.lsock = lsock
+        self.stats = stats
+        self.grace = grace
+        self.started = time.time()
+        self.buffer = b''
+
+    def report (self):
+        r = {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'bounces': scheduler.bounces,
+            'queued': len (scheduler.tasks),
+            }
+        if self.stats is not None:
+            r.update (self.stats())
+        return bytes (json.dumps (r) + '\n', 'utf-8')
+
+    def cps_run (self, k):
+        scheduler.cps_recv (lambda data: self._command (k, data), self.control, 4096)
+
+    def _command (self, k, data):
+        if not data:
+            # the parent has gone.
+            self._stop()
+            k()
+            return
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split (b'\n', 1)
+            if line == b'stats':
+                scheduler.cps_sendall (done, self.control, self.report())
+            elif line == b'stop':
+                self._stop()
+                scheduler.cps_sendall (k, self.control, self.report())
+                return
+        self.cps_run (k)
+
+    def _stop (self):
+        scheduler.close_listener (self.lsock)
+        timer = threading.Timer (self.grace, self._expire)
+        timer.daemon = True
+        timer.start()
+
+    def _expire (self):
+        # connections are still open after <grace>: drop them.
+        self.exit()
+        os._exit (0)
+
+    def exit (self):
+        "send the last line of stats"
+        self.control.setblocking (True)
+        self.control.sendall (self.report())
+
+class worker:
+
+    # the parent's handle on a worker
+
+    def __init__ (self, pid, control):
+        self.pid = pid
+        self.control = control
+        self.file = control.makefile ('rb')
+        # its reply to 'stop'
+        self.last = None
+
+    def __repr__ (self):
+        return '<worker %d>' % (self.pid,)
+
+    def request (self, command):
+        "send <command>, and return the reply line (b'' if the worker has gone)"
+        try:
+            self.control.sendall (command + b'\n')
+        except OSError:
+            return b''
+        return self.file.readline()
+
+    def close (self):
+        self.file.close()
+        self.control.close()
+
+class prefork:
+
+    def __init__ (self, serve, workers=None, address=('127.0.0.1', 0), backlog=4096, stats=None, grace=10.0):
+        self.serve = serve
+        self.nworkers = workers or os.cpu_count() or 1
+        self.backlog = backlog
+        self.stats_function = stats
+        self.grace = grace
+        # holds the port across restarts: bound, never listening.
+        self.hold = reuseport_socket()
+        self.hold.bind (address)
+        self.address = self.hold.getsockname()
+        # pid -> worker
+        self.workers = {}
+        # pid -> stopped worker, not yet reaped
+        self.stopping = {}
+        # final stats of stopped workers
+        self.retired = []
+        self.restarts = 0
+
+    def __repr__ (self):
+        return '<prefork %s:%d workers=%d>' % (self.address[0], self.address[1], len (self.workers))
+
+    def start (self):
+        while len (self.workers) < self.nworkers:
+            self.spawn()
+
+    def spawn (self):
+        "start a worker, and return its pid once it's listening"
+        mine, theirs = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                mine.close()
+                self.worker_main (theirs)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit (status)
+        theirs.close()
+        w = worker (pid, mine)
+        if w.file.readline() != b'ready\n':
+            w.close()
+            os.waitpid (pid, 0)
+            raise OSError ('worker %d failed to start' % (pid,))
+        self.workers[pid] = w
+        return pid
+
+    def worker_main (self, control):
+        # in the child: drop what belongs to the parent.
+        for w in self.workers.values():
+            w.close()
+        self.hold.close()
+        signal.pthread_sigmask (signal.SIG_SETMASK, [])
+        for sig in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal (sig, signal.SIG_IGN)
+        for sig in (signal.SIGTERM, signal.SIGCHLD):
+            signal.signal (sig, signal.SIG_DFL)
+        scheduler.tasks.clear()
+        scheduler.bounces = 0
+        lsock = listener (self.address, self.backlog)
+        loop = control_loop (control, lsock, self.stats_function, self.grace)
+        control.sendall (b'ready\n')
+        control.setblocking (False)
+        scheduler.schedule (loop.cps_run, done)
+        scheduler.schedule (self.serve, done, lsock)
+        scheduler.run()
+        loop.exit()
+
+    def stats (self):
+        "{'workers': [each worker's stats], 'total': their sums, including stopped workers}"
+        reports = []
+        for w in list (self.workers.values()):
+            line = w.request (b'stats')
+            if line:
+                reports.append (json.loads (line))
+        draining = [ w.last for w in self.stopping.values() if w.last is not None ]
+        total = totals (reports + draining + self.retired)
+        total['workers'] = len (reports)
+        total['restarts'] = self.restarts
+        return {'workers': reports, 'total': total}
+
+    def stop_worker (self, pid):
+        "stop worker <pid> gracefully"
+        w = self.workers.pop (pid)
+        line = w.request (b'stop')
+        if line:
+            w.last = json.loads (line)
+        self.stopping[pid] = w
+
+    def retire (self, pid):
+        # worker <pid> has exited: keep its last stats.
+        w = self.stopping.pop (pid)
+        line = w.file.readline()
+        if line:
+            self.retired.append (json.loads (line))
+        elif w.last is not None:
+            self.retired.append (w.last)
+        w.close()
+
+    def restart (self):
+        "replace every worker, one at a time, without refusing or resetting a connection"
+        for pid in list (self.workers):
+            self.spawn()
+            self.stop_worker (pid)
+        self.restarts += 1
+        self.reap()
+
+    def reap (self):
+        "collect workers that have exited, and replace any that weren't stopped"
+        for pid in list (self.stopping) + list (self.workers):
+            try:
+                wpid, status = os.waitpid (pid, os.WNOHANG)
+            except ChildProcessError:
+                wpid = pid
+            if wpid == 0:
+                continue
+            if pid in self.stopping:
+                self.retire (pid)
+            else:
+                self.workers.pop (pid).close()
+                self.spawn()
+
+    def stop (self, wait=True):
+        "stop every worker gracefully; with <wait>, until they've all exited"
+        for pid in list (self.workers):
+            self.stop_worker (pid)
+        if wait:
+            for pid in list (self.stopping):
+                try:
+                    os.waitpid (pid, 0)
+                except ChildProcessError:
+                    pass
+                self.retire (pid)
+
+    def close (self):
+        self.stop()
+        self.hold.close()
+
+    def serve_forever (self):
+        "run until SIGINT or SIGTERM: SIGHUP restarts the workers, SIGUSR1 prints their stats"
+        sigs = set ((signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD))
+        signal.pthread_sigmask (signal.SIG_BLOCK, sigs)
+        try:
+            self.start()
+            while 1:
+                sig = signal.sigwaitinfo (sigs).si_signo
+                if sig in (signal.SIGINT, signal.SIGTERM):
+                    break
+                elif sig == signal.SIGHUP:
+                    self.restart()
+                elif sig == signal.SIGUSR1:
+                    print (json.dumps (self.stats()))
+                    sys.stdout.flush()
+                else:
+                    self.reap()
+        finally:
+            self.close()
+            signal.pthread_sigmask (signal.SIG_UNBLOCK, sigs)
+
+if __name__ == '__main__':
+    import bench_http
+    args = sys.argv[1:]
+    options = {}
+    workers = None
+    port = 8080
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg == '-O':
+            options['optimize'] = True
+        elif arg.startswith ('--workers='):
+            workers = int (arg[len('--workers='):])
+        elif arg.startswith ('--port='):
+            port = int (arg[len('--port='):])
+        else:
+            raise ValueError (arg)
+    httpd = bench_http.load (options)
+    group = prefork (httpd.cps_serve, workers, ('127.0.0.1', port), stats=lambda: {'served': httpd.served})
+    print ('serving on %s:%d with %d workers, pid %d' % (group.address + (group.nworkers, os.getpid())))
+    sys.stdout.flush()
+    group.serve_forever()
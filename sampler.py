@@ -0,0 +1,67 @@
+# -*- Mode: Python -*-
+
+# a sampling profiler for trampolined CPS code.
+#
+# cProfile and py-spy only ever see run() -> kfN under a trampoline, so
+#   instead each sample rebuilds the logical chain of cps_ calls from
+#   the continuations (see scheduler.logical_stack - generate the code
+#   with 'trampoline.py --trace' for complete chains), and counts one
+#   collapsed stack per sample.  The output is the 'folded'
+#   format read by flamegraph.pl, speedscope, inferno, etc:
+#
+#     cps_tak;cps_tak;cps_tak 17
+#
+# sampling is driven by SIGPROF (i.e. CPU time), so it's unix-only and
+#   must be started from the main thread.
+#
+# usage: python sampler.py [-i interval] <output.folded> <program.cps.py> [args...]
+
+import signal
+import sys
+
+import scheduler
+
+class sampler:
+
+    def __init__ (self, interval=0.001):
+        self.interval = interval
+        self.counts = {}
+        self.nsamples = 0
+
+    def sample (self, signum, frame):
+        key = ';'.join (scheduler.logical_stack (frame)) or '<idle>'
+        self.counts[key] = self.counts.get (key, 0) + 1
+        self.nsamples += 1
+
+    def start (self):
+        self.old_handler = signal.signal (signal.SIGPROF, self.sample)
+        signal.setitimer (signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop (self):
+        signal.setitimer (signal.ITIMER_PROF, 0, 0)
+        signal.signal (signal.SIGPROF, self.old_handler)
+
+    def write_collapsed (self, file):
+        for key, count in sorted (self.counts.items()):
+            file.write ('%s %d\n' % (key, count))
+
+def main (args):
+    import runpy
+    interval = 0.001
+    if args[0] == '-i':
+        interval = float (args[1])
+        args = args[2:]
+    out, prog = args[0], args[1]
+    sys.argv = args[1:]
+    s = sampler (interval)
+    s.start()
+    try:
+        runpy.run_path (prog, run_name='__main__')
+    finally:
+        s.stop()
+        with open (out, 'w') as f:
+            s.write_collapsed (f)
+        sys.stderr.write ('%d samples written to %s\n' % (s.nsamples, out))
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
@@ -1,12 +1,718 @@
 # -*- Mode: Python -*-
 
-tasks = []
+import errno
+import os
+import pickle
+import select
+import selectors
+import socket
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from itertools import islice
+from types import GeneratorType
+
+# the queue holds one flat tuple per task, laid out by arity:
+#
+#   (fun,)  (fun, a)  (fun, a, b)           fun(), fun(a), fun(a, b)
+#   (fun, args, token, None)                fun(*args), in token's tree
+#
+#   so the common case - a continuation bounced with zero or one value,
+#   outside any spawn()ed tree - costs one small tuple and no args tuple.
+#   Generated code calls the fixed-arity entry points schedule0/1/2, which
+#   also skip building *args; schedule() takes any arity.
+
+tasks = deque()
+
+# the token of the tree whose continuation is running: anything it
+#   schedules belongs to the same tree.
+current = None
 
 def schedule (fun, *args):
-    tasks.append ((fun, args))
+    if current is None and len (args) < 3:
+        tasks.append ((fun,) + args)
+    else:
+        tasks.append ((fun, args, current, None))
+
+def schedule0 (fun):
+    if current is None:
+        tasks.append ((fun,))
+    else:
+        tasks.append ((fun, (), current, None))
+
+def schedule1 (fun, a):
+    if current is None:
+        tasks.append ((fun, a))
+    else:
+        tasks.append ((fun, (a,), current, None))
+
+def schedule2 (fun, a, b):
+    if current is None:
+        tasks.append ((fun, a, b))
+    else:
+        tasks.append ((fun, (a, b), current, None))
+
+def _push (fun, args, tok):
+    if tok is None and len (args) < 3:
+        tasks.append ((fun,) + args)
+    else:
+        tasks.append ((fun, args, tok, None))
+
+def _unpack (task):
+    "return (fun, args, token) for a queued task"
+    if len (task) == 4:
+        return task[:3]
+    else:
+        return task[0], task[1:], None
+
+def schedule_in (tok, fun, *args):
+    "schedule a task in a particular tree, e.g. to wake a task parked by another one"
+    _push (fun, args, tok)
+
+# tasks taken off the queue so far
+bounces = 0
 
 def run():
-    while len(tasks):
-        fun, args = tasks.pop(0)
-        fun (*args)
-        
+    global current, peak, bounces
+    popleft = tasks.popleft
+    while tasks or _outstanding or _deferred or _io_waiting:
+        if _done:
+            _deliver()
+            # not straight on to _block(): if every result delivered was
+            #   for a cancelled tree, nothing was queued, and with nothing
+            #   outstanding it would wait on the wakeup pipe for ever.  The
+            #   loop condition is checked again first.
+        elif not tasks and not _deferred:
+            # nothing to do but wait for a thread or a socket
+            _block()
+        elif _io_waiting:
+            _poll (0)
+        n = len (tasks)
+        if n > peak:
+            peak = n
+        if paused and n <= _low_water():
+            _resume()
+        # run everything that's ready now, then look for completions again.
+        left = len (tasks)
+        bounces += left
+        while left:
+            # with a tracer, run up to the next task it samples, then that
+            #   one under _record().
+            t = tracing
+            m = left
+            if t is not None and t.skip <= m:
+                m = t.skip - 1
+            left -= m
+            for i in range (m):
+                task = popleft()
+                n = len (task)
+                if n == 2:
+                    fun, a = task
+                    fun (a)
+                elif n == 1:
+                    fun, = task
+                    fun()
+                elif n == 3:
+                    fun, a, b = task
+                    fun (a, b)
+                else:
+                    fun, args, tok, _ = task
+                    if tok is None:
+                        fun (*args)
+                    elif not tok.cancelled:
+                        current = tok
+                        fun (*args)
+                        current = None
+            if t is not None:
+                if left:
+                    left -= 1
+                    t.skip = t.sample
+                    fun, args, tok = _unpack (popleft())
+                    if tok is None or not tok.cancelled:
+                        _record (t, fun, args, tok)
+                else:
+                    t.skip -= m
+
+# backpressure.  a burst of fan-out can queue millions of tasks, each one
+#   holding its closures alive.  With <high_water> set, a producer that
+#   calls cps_admit() before taking on more work (before it spawns, or
+#   accepts a connection) is parked once the queue holds that many tasks,
+#   and let back in, oldest first, when it has drained to <low_water>.
+#   A parked producer holds only its own continuation, so admit before
+#   allocating the work, not after.  Continuations of work already
+#   started are never held back.
+
+high_water = None
+# defaults to half of high_water
+low_water = None
+
+# True while producers are being parked
+paused = False
+# most tasks seen queued at once
+peak = 0
+# parked producers, as (fun, args, token)
+_deferred = deque()
+
+def _low_water():
+    if low_water is None:
+        return high_water // 2
+    return low_water
+
+def _full():
+    global paused
+    if not paused and high_water is not None and len (tasks) >= high_water:
+        paused = True
+    return paused
+
+def _resume():
+    global paused
+    paused = False
+    while _deferred and (len (tasks) < high_water or not tasks):
+        _push (*_deferred.popleft())
+    if _deferred:
+        paused = True
+
+def cps_admit (k):
+    "CPS primitive: continue now if the queue is below the high water mark, else when it drains"
+    if _full():
+        _deferred.append ((k, (), current))
+    else:
+        k()
+
+def _task_bytes (task):
+    fun, args, tok = task
+    n = sys.getsizeof (task) + sys.getsizeof (args)
+    for arg in args:
+        n += sys.getsizeof (arg)
+    closure = getattr (fun, '__closure__', None)
+    if closure:
+        for cell in closure:
+            n += sys.getsizeof (cell)
+            try:
+                n += sys.getsizeof (cell.cell_contents)
+            except ValueError:
+                pass
+    env = getattr (fun, 'env', None)
+    if env is not None:
+        # a lift.py Closure: its frame holds the locals
+        n += sys.getsizeof (env) + sum (sys.getsizeof (v) for v in vars (env).values())
+    return n
+
+def memory_stats (sample=1000):
+    "queue sizes, and the approximate bytes held by pending tasks (estimated from a sample)"
+    pending = len (tasks) + len (_deferred)
+    if pending:
+        step = max (1, pending // sample)
+        # every <step>th of the queue then the deferred, walked rather
+        #   than indexed: indexing a deque is O(n).
+        sizes = [ _task_bytes (_unpack (task)) for task in islice (tasks, 0, None, step) ]
+        sizes.extend (_task_bytes (task) for task in islice (_deferred, -len (tasks) % step, None, step))
+        nbytes = sum (sizes) * pending // len (sizes)
+    else:
+        nbytes = 0
+    return {
+        'pending': len (tasks),
+        'deferred': len (_deferred),
+        'peak': peak,
+        'paused': paused,
+        'bytes': nbytes,
+        }
+
+# cancellation.  spawn() starts a task tree with a token of its own, and
+#   token.cancel() stops it: nothing is searched for, the tree's
+#   continuations are just dropped as they come off the queue (or out of
+#   the thread pool, or off a channel or pool.py wait list), so a cancel
+#   costs the same however much of the tree is pending.  thread pool calls
+#   that haven't started yet are cancelled outright, and sockets the tree
+#   is parked on are taken off the selector, so run() can return.
+
+_tree_ids = 0
+
+class token:
+
+    __slots__ = ('id', 'cancelled', 'cleanup', 'pending', 'sockets')
+
+    def __init__ (self, cleanup=None):
+        global _tree_ids
+        _tree_ids += 1
+        # names the tree in traces
+        self.id = _tree_ids
+        self.cancelled = False
+        # a continuation to run (with no arguments) on cancel
+        self.cleanup = cleanup
+        # thread pool futures the tree is waiting on
+        self.pending = set()
+        # sockets the tree is parked on
+        self.sockets = set()
+
+    def __repr__ (self):
+        return '<token %d%s>' % (self.id, ' cancelled' if self.cancelled else '')
+
+    def cancel (self):
+        global _io_waiting
+        if not self.cancelled:
+            self.cancelled = True
+            for future in self.pending:
+                future.cancel()
+            for sock in self.sockets:
+                _selector.unregister (sock)
+                _io_waiting -= 1
+            self.sockets.clear()
+            if self.cleanup is not None:
+                tasks.append ((self.cleanup,))
+
+def spawn (fun, *args, cleanup=None):
+    "start a new task tree running fun(*args), and return its token"
+    tok = token (cleanup)
+    tasks.append ((fun, args, tok, None))
+    return tok
+
+# tracing.  with a tracer started, run() records each continuation it
+#   runs (or every <sample>th one) in a ring buffer allocated up front:
+#   start and stop times, its code, its task tree, and how many tasks were
+#   queued behind it.  Only the last <capacity> are kept, so it can be
+#   left running, and dumped when something looks slow.  dump() writes
+#   Chrome trace-event JSON, for chrome://tracing or ui.perfetto.dev: one
+#   track per task tree, and a counter for the queue depth.
+#
+#   t = scheduler.start_trace (sample=10)
+#   ...
+#   with open ('cps.trace.json', 'w') as f:
+#       t.dump (f)
+#
+# untraced, the cost is one test per generation.  The buffer holds code
+#   objects rather than the continuations themselves, so it keeps no
+#   closures alive (a lift.py Closure is kept until it's overwritten).
+
+class tracer:
+
+    def __init__ (self, capacity=65536, sample=1):
+        self.capacity = capacity
+        self.sample = sample
+        self.starts = array ('d', bytes (8 * capacity))
+        self.stops = array ('d', bytes (8 * capacity))
+        self.trees = array ('q', bytes (8 * capacity))
+        self.depths = array ('q', bytes (8 * capacity))
+        self.codes = [None] * capacity
+        # records written, including those since overwritten
+        self.count = 0
+        # tasks until the next sample
+        self.skip = 1
+
+    def records (self):
+        "(start, stop, name, tree, depth) for each record still in the buffer, oldest first"
+        n = min (self.count, self.capacity)
+        for i in range (self.count - n, self.count):
+            j = i % self.capacity
+            code = self.codes[j]
+            name = getattr (code, 'co_qualname', None) or getattr (code, '__qualname__', None) or repr (code)
+            yield self.starts[j], self.stops[j], name, self.trees[j], self.depths[j]
+
+    def events (self):
+        "the records as Chrome trace events"
+        pid = os.getpid()
+        trees = set()
+        r = []
+        for start, stop, name, tree, depth in self.records():
+            trees.add (tree)
+            r.append ({
+                'name': name, 'ph': 'X', 'pid': pid, 'tid': tree,
+                'ts': start * 1e6, 'dur': (stop - start) * 1e6,
+                'args': {'queued': depth},
+                })
+            r.append ({'name': 'queue', 'ph': 'C', 'pid': pid, 'ts': start * 1e6, 'args': {'depth': depth}})
+        for tree in sorted (trees):
+            r.append ({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tree,
+                'args': {'name': 'tree %d' % (tree,) if tree else 'no tree'},
+                })
+        return r
+
+    def dump (self, file):
+        "write the buffer to <file> as Chrome trace-event JSON"
+        import json
+        json.dump ({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, file)
+
+# the running tracer
+tracing = None
+
+def start_trace (capacity=65536, sample=1):
+    "start recording every <sample>th continuation run into a new tracer, and return it"
+    global tracing
+    tracing = tracer (capacity, sample)
+    return tracing
+
+def stop_trace():
+    "stop recording, and return the tracer"
+    global tracing
+    t, tracing = tracing, None
+    return t
+
+def _record (t, fun, args, tok):
+    global current
+    depth = len (tasks)
+    current = tok
+    start = time.perf_counter()
+    fun (*args)
+    stop = time.perf_counter()
+    current = None
+    j = t.count % t.capacity
+    t.starts[j] = start
+    t.stops[j] = stop
+    t.codes[j] = getattr (fun, '__code__', fun)
+    t.trees[j] = 0 if tok is None else tok.id
+    t.depths[j] = depth
+    t.count += 1
+
+# blocking calls are run on a thread pool, and their results handed back to
+#   the scheduler through <_done> (so can any other thread's, through a
+#   future).  the first completion of a batch writes a byte to a
+#   self-pipe, so a scheduler with nothing else to do can sleep in
+#   select() until there's something to deliver.
+
+thread_pool_size = 8
+
+_pool = None
+_outstanding = 0
+_done = []
+_done_lock = threading.Lock()
+_wakeup_r = _wakeup_w = None
+
+def _finished (k, tok, future):
+    # runs in the worker thread
+    with _done_lock:
+        _done.append ((k, tok, future))
+        if len (_done) == 1:
+            os.write (_wakeup_w, b'x')
+
+def _raise (e):
+    raise e
+
+def _deliver():
+    global _outstanding
+    with _done_lock:
+        batch = _done[:]
+        del _done[:]
+        try:
+            os.read (_wakeup_r, 1)
+        except BlockingIOError:
+            pass
+    _outstanding -= len (batch)
+    for k, tok, future in batch:
+        if tok is not None:
+            tok.pending.discard (future)
+            if tok.cancelled:
+                continue
+        e = future.exception()
+        if e is None:
+            _push (k, (future.result(),), tok)
+        else:
+            _push (_raise, (e,), tok)
+
+def cps_wait_future (k, future):
+    "CPS primitive: continue with the result of a concurrent.futures.Future, which another thread will set."
+    global _outstanding, _wakeup_r, _wakeup_w
+    if _wakeup_r is None:
+        _wakeup_r, _wakeup_w = os.pipe()
+        os.set_blocking (_wakeup_r, False)
+    _outstanding += 1
+    tok = current
+    if tok is not None:
+        tok.pending.add (future)
+    future.add_done_callback (lambda future: _finished (k, tok, future))
+
+# a forked child starts with no selector, thread pool or wakeup pipe of
+#   its own: the parent's epoll set would be shared with it, and its
+#   threads don't exist there.
+def _after_fork():
+    global _selector, _io_waiting, _pool, _outstanding, _done_lock, _wakeup_r, _wakeup_w
+    _selector = None
+    _io_waiting = 0
+    _pool = None
+    _outstanding = 0
+    del _done[:]
+    _done_lock = threading.Lock()
+    _wakeup_r = _wakeup_w = None
+    _closing.clear()
+
+if hasattr (os, 'register_at_fork'):
+    os.register_at_fork (after_in_child=_after_fork)
+
+def cps_run_in_thread (k, fun, *args):
+    "CPS primitive: call fun(*args) on the thread pool, and continue with its result."
+    global _pool
+    if _pool is None:
+        import concurrent.futures
+        _pool = concurrent.futures.ThreadPoolExecutor (thread_pool_size)
+    cps_wait_future (k, _pool.submit (fun, *args))
+
+# the generator backend (coroutine.py).  a cps_ function there is a
+#   generator: it yields another one's generator to call it, or a pair
+#   (fun, args) to call the CPS primitive fun (k, *args), and returns its
+#   result.  _drive steps a stack of them - the caller chain - straight
+#   through calls and returns, only leaving it when a primitive suspends,
+#   or when it's run <generator_slice> steps, to let the queue go round.
+#   An exception is thrown into the caller, and so on down the stack.
+
+generator_slice = 1000
+
+def cps_generator (k, gen):
+    "CPS primitive: run the generator-backend coroutine <gen>, and continue with what it returns."
+    _drive ([gen], k, None)
+
+def _resumer (stack, k):
+    def resume (*result):
+        schedule (_drive, stack, k, result[0] if result else None)
+    return resume
+
+def _drive (stack, k, value, error=None):
+    gen = stack[-1]
+    for i in range (generator_slice):
+        try:
+            if error is None:
+                request = gen.send (value)
+            else:
+                request = gen.throw (error)
+                error = None
+        except StopIteration as stop:
+            stack.pop()
+            value = stop.value
+            error = None
+            if not stack:
+                schedule1 (k, value)
+                return
+            gen = stack[-1]
+            continue
+        except Exception as e:
+            stack.pop()
+            if not stack:
+                raise
+            error = e
+            gen = stack[-1]
+            continue
+        if type (request) is GeneratorType:
+            stack.append (request)
+            gen = request
+            value = None
+        else:
+            fun, args = request
+            try:
+                fun (_resumer (stack, k), *args)
+            except Exception as e:
+                error = e
+                continue
+            return
+    schedule (_drive, stack, k, value, error)
+
+# socket I/O, on non-blocking sockets.  a call that would block parks
+#   itself with a selector, to be retried when the socket is ready: run()
+#   polls for that between generations while there's other work, and
+#   sleeps on it (and the thread pool's wakeup pipe) when there isn't.  A
+#   socket can have one waiter at a time.  A connection reset reads as
+#   EOF, and a send to a closed connection is dropped: the next cps_recv
+#   sees the EOF.  close_listener() ends an accept loop gracefully, and
+#   cps_accept() waits on cps_admit() first, so a server stops accepting
+#   while the queue is above <high_water>.
+
+_selector = None
+# sockets with a parked call
+_io_waiting = 0
+
+def _wait_io (sock, events, fun, args):
+    global _selector, _io_waiting
+    if _selector is None:
+        _selector = selectors.DefaultSelector()
+    _selector.register (sock, events, (fun, args, current))
+    _io_waiting += 1
+    if current is not None:
+        current.sockets.add (sock)
+
+def _poll (timeout):
+    global _io_waiting
+    for key, events in _selector.select (timeout):
+        if key.data is None:
+            # the wakeup pipe: run() delivers the completions.
+            continue
+        _selector.unregister (key.fileobj)
+        _io_waiting -= 1
+        fun, args, tok = key.data
+        if tok is None:
+            _push (fun, args, tok)
+        elif not tok.cancelled:
+            tok.sockets.discard (key.fileobj)
+            _push (fun, args, tok)
+
+def _block():
+    if not _io_waiting:
+        select.select ([_wakeup_r], [], [])
+    else:
+        if _wakeup_r is not None and _wakeup_r not in _selector.get_map():
+            _selector.register (_wakeup_r, selectors.EVENT_READ, None)
+        _poll (None)
+    if _done:
+        _deliver()
+
+# listeners being closed by close_listener()
+_closing = set()
+
+def cps_accept (k, lsock):
+    "CPS primitive: continue with the next connection (non-blocking) on the listening <lsock>, or None once it's closing"
+    # under backpressure (see cps_admit), take no new connections until
+    #   the queue has drained.
+    cps_admit (lambda: _accept (k, lsock))
+
+def _accept (k, lsock):
+    try:
+        sock, address = lsock.accept()
+    except BlockingIOError:
+        if lsock in _closing:
+            _closing.discard (lsock)
+            k (None)
+        else:
+            _wait_io (lsock, selectors.EVENT_READ, cps_accept, (k, lsock))
+    else:
+        sock.setblocking (False)
+        k (sock)
+
+def close_listener (lsock):
+    "stop accepting on <lsock>: cps_accept takes what's already queued on it, then continues with None"
+    # rather than closing it outright, which would reset what's queued -
+    #   and with SO_REUSEPORT, other listeners can take over the port.
+    global _io_waiting
+    _closing.add (lsock)
+    if _selector is not None and lsock in _selector.get_map():
+        # retry the parked accept now.
+        fun, args, tok = _selector.unregister (lsock).data
+        _io_waiting -= 1
+        if tok is not None:
+            tok.sockets.discard (lsock)
+        _push (fun, args, tok)
+
+def _connected (k, sock):
+    err = sock.getsockopt (socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        sock.close()
+        raise OSError (err, os.strerror (err))
+    k (sock)
+
+def cps_connect (k, address):
+    "CPS primitive: continue with a non-blocking socket connected to the IPv4 (host, port) <address>"
+    sock = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking (False)
+    err = sock.connect_ex (address)
+    if err == 0:
+        k (sock)
+    elif err in (errno.EINPROGRESS, errno.EAGAIN):
+        _wait_io (sock, selectors.EVENT_WRITE, _connected, (k, sock))
+    else:
+        sock.close()
+        raise OSError (err, os.strerror (err))
+
+def cps_recv (k, sock, n):
+    "CPS primitive: continue with up to <n> bytes from <sock>, or b'' at EOF"
+    try:
+        data = sock.recv (n)
+    except BlockingIOError:
+        _wait_io (sock, selectors.EVENT_READ, cps_recv, (k, sock, n))
+    except ConnectionResetError:
+        k (b'')
+    else:
+        k (data)
+
+def cps_sendall (k, sock, data):
+    "CPS primitive: send all of <data> on <sock>"
+    while data:
+        try:
+            n = sock.send (data)
+        except BlockingIOError:
+            _wait_io (sock, selectors.EVENT_WRITE, cps_sendall, (k, sock, data))
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            break
+        if n < len (data):
+            data = memoryview (data)[n:]
+        else:
+            break
+    k()
+
+# rebuild the logical call chain from a real stack frame.  a cps_
+#   function is anything whose first argument is 'k', and a continuation
+#   is anything that closes over 'k': its qualname names the cps_ function
+#   it belongs to, and its 'k' is the caller's continuation.  code
+#   generated by 'trampoline.py --trace' makes sure every continuation
+#   closes over 'k'; otherwise the chain may stop early.
+
+def _cps_name (code):
+    if code.co_argcount and code.co_varnames[0] == 'k':
+        return code.co_name
+    qualname = getattr (code, 'co_qualname', code.co_name)
+    if '.<locals>.' in qualname:
+        return qualname.split ('.', 1)[0]
+    else:
+        return '<module>'
+
+def _is_cps (code):
+    return 'k' in code.co_freevars or (code.co_argcount and code.co_varnames[0] == 'k')
+
+def logical_stack (frame=None):
+    "return the names of the logical cps_ call chain, outermost first"
+    if frame is None:
+        frame = sys._getframe (1)
+    r = []
+    k = None
+    while frame is not None:
+        if _is_cps (frame.f_code):
+            r.append (_cps_name (frame.f_code))
+            k = frame.f_locals.get ('k')
+            break
+        elif frame.f_code in (run.__code__, _record.__code__):
+            # between tasks: charge it to the one just run.
+            k = frame.f_locals.get ('fun')
+            break
+        frame = frame.f_back
+    while k is not None:
+        code = getattr (k, '__code__', None)
+        if code is None or not _is_cps (code):
+            break
+        r.append (_cps_name (code))
+        if 'k' in code.co_freevars:
+            k = k.__closure__[code.co_freevars.index ('k')].cell_contents
+        else:
+            k = None
+    r.reverse()
+    return r
+
+# picklable continuations, as emitted by lift.py.
+#   a Frame holds the locals of one activation of a cps_ function, and a
+#   Closure pairs a module-level continuation function with its frame.
+
+class Frame:
+    pass
+
+class Closure:
+    __slots__ = ('fun', 'env')
+    def __init__ (self, fun, env):
+        self.fun = fun
+        self.env = env
+    def __call__ (self, *args):
+        return self.fun (self.env, *args)
+    def __reduce__ (self):
+        return (Closure, (self.fun, self.env))
+    def __repr__ (self):
+        return '<Closure %s>' % (self.fun.__qualname__,)
+
+# checkpoint/migrate the pending queue.  every task must be picklable,
+#   which in practice means the code was generated by lift.py.
+
+def dump (file, drain=False):
+    "write the pending tasks to <file>; with <drain>, also remove them from the queue"
+    pickle.dump ([ _unpack (task) for task in tasks ], file)
+    if drain:
+        tasks.clear()
+
+def load (file):
+    "append tasks written by dump() to the queue"
+    for fun, args, tok in pickle.load (file):
+        _push (fun, args, tok)
@@ -0,0 +1,244 @@
+# -*- Mode: Python -*-
+
+# a simulation scheduler on a virtual clock, with the same schedule/run
+#   interface as scheduler.py (convert with 'trampoline.py --runtime=sim').
+#
+# nothing here ever sleeps: when no continuation is ready, run() moves the
+#   clock straight to the next timer deadline.  So a load test with a
+#   million timers and realistic network latencies runs as fast as the
+#   continuations themselves, and every time reported is virtual.
+#
+# with seed(n), runs are deterministic but shuffled: the continuations
+#   ready at the same moment, and timers due at the same moment, run in an
+#   order drawn from a PRNG seeded with n.  Different seeds explore
+#   different interleavings; the same seed replays one exactly.  Without a
+#   seed the order is FIFO.
+#
+#   cps_sleep (k, dt)                   continue after dt virtual seconds
+#   call_later (dt, fun, *args)         returns a timer, with .cancel()
+#   cps_with_timeout (k, dt, fun, *args)
+#                                       call the cps_ function fun(k, *args);
+#                                       continue with (True, result), or with
+#                                       (False, None) if dt passes first
+#   endpoint (...)                      a simulated server: see below
+#   stats()                             collects latencies, reports in virtual time
+
+import heapq
+import random
+from collections import deque
+
+# virtual time, in seconds
+now = 0.0
+
+tasks = deque()
+# (deadline, tiebreak, timer)
+_timers = []
+_seq = 0
+_rng = None
+
+def seed (n):
+    "make ordering deterministic but shuffled, from the PRNG seed <n>"
+    global _rng
+    _rng = random.Random (n)
+
+def rng():
+    "the simulation's PRNG, for drawing latencies etc. (seeded by seed())"
+    global _rng
+    if _rng is None:
+        _rng = random.Random (0)
+    return _rng
+
+def reset():
+    "back to time zero, with nothing queued"
+    global now, _seq
+    now = 0.0
+    _seq = 0
+    tasks.clear()
+    del _timers[:]
+
+def schedule (fun, *args):
+    tasks.append ((fun, args))
+
+# the fixed-arity entry points that trampoline output calls.
+schedule0 = schedule1 = schedule2 = schedule
+
+class timer:
+
+    __slots__ = ('deadline', 'fun', 'args', 'cancelled')
+
+    def __init__ (self, deadline, fun, args):
+        self.deadline = deadline
+        self.fun = fun
+        self.args = args
+        self.cancelled = False
+
+    def __lt__ (self, other):
+        # only reached if two timers share a deadline and a tiebreak.
+        return id (self) < id (other)
+
+    def cancel (self):
+        # it stays in the heap, and is skipped when it comes due.
+        self.cancelled = True
+
+def call_later (dt, fun, *args):
+    "run fun(*args) <dt> virtual seconds from now"
+    global _seq
+    t = timer (now + dt, fun, args)
+    _seq += 1
+    if _rng is None:
+        key = _seq
+    else:
+        key = _rng.random()
+    heapq.heappush (_timers, (t.deadline, key, t))
+    return t
+
+def cps_sleep (k, dt):
+    "CPS primitive: continue after <dt> virtual seconds"
+    call_later (dt, k)
+
+def cps_with_timeout (k, dt, fun, *args):
+    "CPS primitive: continue with (True, fun's result), or (False, None) after <dt>"
+    state = [False]
+    def expired():
+        if not state[0]:
+            state[0] = True
+            k ((False, None))
+    t = call_later (dt, expired)
+    def finished (*result):
+        if not state[0]:
+            state[0] = True
+            t.cancel()
+            k ((True, result[0] if result else None))
+    fun (finished, *args)
+
+def run (until=None):
+    "run until nothing is ready or pending, or the clock would pass <until>"
+    global now
+    popleft = tasks.popleft
+    while 1:
+        if _rng is not None and len (tasks) > 1:
+            batch = list (tasks)
+            tasks.clear()
+            _rng.shuffle (batch)
+            tasks.extend (batch)
+        for i in range (len (tasks)):
+            fun, args = popleft()
+            fun (*args)
+        if tasks:
+            continue
+        # nothing ready: jump to the next deadline, and make everything due then ready.
+        while _timers and _timers[0][2].cancelled:
+            heapq.heappop (_timers)
+        if not _timers:
+            break
+        deadline = _timers[0][0]
+        if until is not None and deadline > until:
+            now = until
+            break
+        now = deadline
+        while _timers and _timers[0][0] == deadline:
+            t = heapq.heappop (_timers)[2]
+            if not t.cancelled:
+                tasks.append ((t.fun, t.args))
+
+# latency/throughput collection, in virtual time.
+
+class stats:
+
+    def __init__ (self, name=''):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.start = now
+        self.end = now
+
+    def record (self, latency):
+        self.latencies.append (latency)
+        self.end = now
+
+    def error (self):
+        self.errors += 1
+        self.end = now
+
+    def percentile (self, p):
+        if not self.latencies:
+            return 0.0
+        xs = sorted (self.latencies)
+        return xs[min (len (xs) - 1, int (len (xs) * p))]
+
+    def report (self):
+        n = len (self.latencies)
+        elapsed = self.end - self.start
+        xs = sorted (self.latencies)
+        def pct (p):
+            return xs[min (n - 1, int (n * p))] * 1000 if n else 0.0
+        return (
+            '%s%d ok, %d errors in %.3fs virtual: %.0f/s  '
+            'latency ms p50 %.2f p90 %.2f p99 %.2f max %.2f' % (
+                (self.name + ': ') if self.name else '',
+                n, self.errors, elapsed, n / elapsed if elapsed else 0.0,
+                pct (0.5), pct (0.9), pct (0.99), pct (1.0)
+                )
+            )
+
+# simulated I/O.  An endpoint is a server at the other end of a network
+#   link: a request spends <latency> on the wire each way, and in between
+#   waits for one of <concurrency> workers, which take <service> to handle
+#   it.  Either may be a number of seconds, or a function of the PRNG that
+#   draws one, e.g. lambda r: r.expovariate (1 / 0.002).  <handler>, if
+#   given, computes the reply from the request.
+
+def _draw (x):
+    if callable (x):
+        return x (rng())
+    return x
+
+class endpoint:
+
+    def __init__ (self, latency=0.0005, service=0.001, concurrency=1, handler=None, name=''):
+        self.latency = latency
+        self.service = service
+        self.concurrency = concurrency
+        self.handler = handler
+        self.name = name
+        self.busy = 0
+        self.queue = deque()
+        # stats
+        self.served = 0
+        self.max_queue = 0
+        self.busy_time = 0.0
+
+    def __repr__ (self):
+        return '<endpoint %s served=%d max_queue=%d>' % (self.name, self.served, self.max_queue)
+
+    def cps_request (self, k, req=None):
+        "CPS primitive: send <req> over the link, continue with the reply"
+        call_later (_draw (self.latency), self._arrive, k, req)
+
+    def _arrive (self, k, req):
+        if self.busy < self.concurrency:
+            self._start (k, req)
+        else:
+            self.queue.append ((k, req))
+            if len (self.queue) > self.max_queue:
+                self.max_queue = len (self.queue)
+
+    def _start (self, k, req):
+        self.busy += 1
+        dt = _draw (self.service)
+        self.busy_time += dt
+        call_later (dt, self._done, k, req)
+
+    def _done (self, k, req):
+        self.busy -= 1
+        self.served += 1
+        if self.queue:
+            self._start (*self.queue.popleft())
+        reply = self.handler (req) if self.handler is not None else req
+        call_later (_draw (self.latency), k, reply)
+
+    def utilization (self, elapsed=None):
+        "fraction of worker time spent busy, over <elapsed> (default: the clock)"
+        if elapsed is None:
+            elapsed = now
+        return self.busy_time / (elapsed * self.concurrency) if elapsed else 0.0
@@ -0,0 +1,135 @@
+# -*- Mode: Python -*-
+
+# a work-stealing, multi-threaded scheduler with the same schedule/run
+#   interface as scheduler.py (convert with 'trampoline.py --runtime=steal').
+#
+# This is only worth it on a free-threaded CPython (3.13t and later); with
+#   the GIL the threads just take turns, so the default there is one.
+#
+# Each worker has its own deque of ready continuations.  A continuation
+#   scheduled by a worker goes on that worker's deque, and the worker takes
+#   its most recent one next, so a task tree tends to stay on one thread
+#   with its data warm in cache.  A worker that runs dry steals the oldest
+#   task from another worker (or from the injection queue, which holds
+#   anything scheduled from outside run(), e.g. by module-level code).
+#   run() returns when every worker is idle and every deque is empty.
+#
+# The order in which continuations run is not FIFO, and two continuations
+#   from different task trees may run at the same time: code that shares
+#   mutable state between trees must lock it.
+
+import os
+import random
+import sys
+import threading
+from collections import deque
+
+def _default_threads():
+    if os.environ.get ('CPS_THREADS'):
+        return int (os.environ['CPS_THREADS'])
+    is_gil_enabled = getattr (sys, '_is_gil_enabled', None)
+    if is_gil_enabled is not None and not is_gil_enabled():
+        return os.cpu_count() or 1
+    return 1
+
+nthreads = _default_threads()
+
+# tasks scheduled from outside a worker.
+_inject = deque()
+_local = threading.local()
+
+def schedule (fun, *args):
+    try:
+        q = _local.q
+    except AttributeError:
+        q = _inject
+    q.append ((fun, args))
+
+# the fixed-arity entry points that trampoline output calls.
+schedule0 = schedule1 = schedule2 = schedule
+
+class _pool:
+
+    def __init__ (self, n):
+        self.queues = [ deque() for i in range (n) ]
+        self.cv = threading.Condition()
+        self.idle = 0
+        self.done = False
+        self.error = None
+        # per-worker count of continuations run
+        self.ran = [0] * n
+
+    def steal (self, me):
+        victims = self.queues[:me] + self.queues[me+1:]
+        random.shuffle (victims)
+        for q in [_inject] + victims:
+            try:
+                return q.popleft()
+            except IndexError:
+                pass
+        return None
+
+    def empty (self):
+        return not _inject and not any (self.queues)
+
+    def wait_for_work (self):
+        # returns False when everyone is out of work.
+        with self.cv:
+            self.idle += 1
+            while 1:
+                if self.done:
+                    return False
+                elif not self.empty():
+                    self.idle -= 1
+                    return True
+                elif self.idle == len (self.queues):
+                    self.done = True
+                    self.cv.notify_all()
+                    return False
+                else:
+                    # nobody notifies us of new work (that would cost every
+                    #   schedule() a lock), so poll.
+                    self.cv.wait (0.0005)
+
+    def worker (self, me):
+        q = _local.q = self.queues[me]
+        pop = q.pop
+        ran = 0
+        try:
+            while not self.done:
+                try:
+                    fun, args = pop()
+                except IndexError:
+                    task = self.steal (me)
+                    if task is None:
+                        if not self.wait_for_work():
+                            break
+                        continue
+                    fun, args = task
+                fun (*args)
+                ran += 1
+        except BaseException as e:
+            with self.cv:
+                self.error = e
+                self.done = True
+                self.cv.notify_all()
+        finally:
+            self.ran[me] = ran
+            del _local.q
+
+# stats from the last run()
+last_pool = None
+
+def run (n=None):
+    global last_pool
+    if n is None:
+        n = nthreads
+    pool = last_pool = _pool (n)
+    threads = [ threading.Thread (target=pool.worker, args=(i,)) for i in range (1, n) ]
+    for t in threads:
+        t.start()
+    pool.worker (0)
+    for t in threads:
+        t.join()
+    if pool.error is not None:
+        raise pool.error
@@ -4,25 +4,97 @@ import ast
 import sys
 from transform import *
 
+# continuations are bounced through the runtime's fixed-arity entry
+#   points (schedule0, schedule1), which don't have to build an args tuple.
+#   They, and the cps_ functions, are left as globals: on 3.11+ a global
+#   load is specialised and cheap, while binding them as locals (e.g. as
+#   keyword defaults) costs a closure cell per call wherever a nested
+#   continuation uses them, and made tak slower.
+
 class trampoline (transformer):
 
     def invoke_continuation (self, name, dead=False):
         if dead:
-            return dead_cont (lambda: Call ('schedule', [name], NullCont))
+            return dead_cont (lambda: Invoke (name, [], 'schedule0'))
         else:
-            return make_cont (lambda var: Call ('schedule', [name, var], NullCont))
+            return make_cont (lambda var: Invoke (name, [var], 'schedule1'))
+
+# logical frames: the real python stack under a trampoline is always just
+#   run() -> kfN, so scheduler.logical_stack() rebuilds the chain of cps_
+#   calls by following continuations instead: a continuation's qualname
+#   names the cps_ function it belongs to, and if it closes over that
+#   function's 'k' we can step to the caller's continuation, and so on.
+#   Most continuations reference 'k' somewhere already; with tracing on,
+#   the others get a reference in dead code.  The compiler drops the
+#   code but keeps the closure cell, so it costs nothing per call.
+
+class TracedFunctionDef (FunctionDef):
+    def emit (self, out):
+        name, kfunp, decs, nonlocals, yeslocals, formals = self.params
+        formals0 = ', '.join ([ x.arg for x in formals.args ])
+        out ('def %s (%s):' % (name, formals0,))
+        out.indent()
+        if nonlocals:
+            out ('nonlocal %s' % (', '.join (nonlocals),))
+        for x in sorted (self.predeclare):
+            out ('%s = None' % (x,))
+        if kfunp:
+            out ('if 0: k')
+        self.subs[0].emit_all (out)
+        out.dedent()
 
-def dofile (path):
+class traced (trampoline):
+
+    def make_function (self, name, kfunp, args, decorator_list, body, k):
+        return TracedFunctionDef (name, kfunp, args, decorator_list, body, k)
+
+# <runtime> is the module the generated code takes schedule/run from.
+#   with a transform_cache, only what changed since the last call is
+#   converted again.
+def dofile (path, transformer=trampoline, runtime='scheduler', cache=None, **options):
     import os
-    cps = transform (path, trampoline)
+    if cache is not None:
+        code = cache.transform (path, transformer, **options)
+    else:
+        cps = transform (path, transformer, **options)
     base, ext = os.path.splitext (path)
     fout = open (base + '.cps.py', 'wb')
-    fout.write (b'\nfrom scheduler import schedule, run\n\n')
-    w = writer (fout)
-    cps.emit_all (w)
+    fout.write (bytes ('\nfrom %s import schedule, schedule0, schedule1, schedule2, run\n\n' % (runtime,), 'utf-8'))
+    if cache is not None:
+        fout.write (code)
+    else:
+        w = writer (fout)
+        cps.emit_all (w)
     fout.write (b'\nrun()\n')
     fout.close()
 
 if __name__ == '__main__':
-    for path in sys.argv[1:]:
-        dofile (path)
+    args = sys.argv[1:]
+    transformer = trampoline
+    runtime = 'scheduler'
+    options = {}
+    report = False
+    baseline = None
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg == '--trace':
+            transformer = traced
+        elif arg == '--dual':
+            options['dual'] = True
+        elif arg == '--inline':
+            options['inline'] = True
+        elif arg == '-O':
+            options['optimize'] = True
+        elif arg.startswith ('--runtime='):
+            runtime = arg[len('--runtime='):]
+        elif arg == '--report':
+            report = True
+        elif arg.startswith ('--baseline='):
+            baseline = arg[len('--baseline='):]
+        else:
+            raise ValueError (arg)
+    if report:
+        report_main (args, transformer, baseline, **options)
+    else:
+        for path in args:
+            dofile (path, transformer, runtime, **options)
@@ -1,6 +1,8 @@
 # -*- Mode: Python -*-
 
 import ast
+import copy
+import re
 # this is the unparse module from Python/Tools/parser/unparse.py
 import unparse
 
@@ -34,7 +36,6 @@ import unparse
 # TODO:
 #  * some kind of importy or decoratory magic to automatically run this at load time.
 #  * exceptions (think about exception-passing style)
-#  * 'continue': need some way of identifying the innermost loop's continuation function.
 #  * for loops
 #  * need an 'invoke_function' method so CPS calls can be scheduled (not just continuations, or
 #    maybe instead of continuations?)
@@ -120,18 +121,33 @@ def search_lenv0 (name, lenv):
     
 # identify all 'local' variables in the CPS tree, by searching
 #   for Assign nodes [XXX that do not refer to globals].
-def find_locals (root, lenv):
+#   <kfun> is true inside a continuation function: a local that is only
+#   ever assigned there must still be bound in its real function, or the
+#   'nonlocal' declarations for it won't compile.
+def find_locals (root, lenv, kfun=False):
     for node in walk (root):
+        # the function's env only covers its body, not the nodes after it.
+        env, inside = lenv, kfun
         if isinstance (node, FunctionDef):
             # only extend the env with *real* functions, not continuation funs
-            if not node.kfunp:
-                lenv = (node, lenv)
+            if node.kfunp:
+                inside = True
+            else:
+                env, inside = (node, lenv), False
+                node.direct = set (x.arg for x in node.formals.args)
+                node.predeclare = set()
         elif isinstance (node, Assign):
             if lenv and not search_lenv0 (node.name, lenv):
                 #print 'found local %r for function %r' % (node.name, lenv[0].name)
                 lenv[0].yeslocals.add (node.name)
+                if kfun:
+                    lenv[0].predeclare.add (node.name)
+                else:
+                    lenv[0].direct.add (node.name)
         for sub in node.subs:
-            find_locals (sub, lenv)
+            find_locals (sub, env, inside)
+    if lenv and not kfun:
+        lenv[0].predeclare.difference_update (lenv[0].direct)
 
 def search_lenv1 (name, lenv):
     while lenv:
@@ -140,16 +156,19 @@ def search_lenv1 (name, lenv):
             return True
     return False
 
+# a continuation function that reads or assigns a local of an enclosing
+#   real function needs a 'nonlocal' for it.
 def find_nonlocals (root, lenv):
     for node in walk (root):
+        env = lenv
         if isinstance (node, FunctionDef):
-            lenv = (node, lenv)
-        elif isinstance (node, Name):
-            if search_lenv1 (node.name, lenv):
+            env = (node, lenv)
+        elif isinstance (node, (Name, Assign)):
+            if lenv and lenv[0].kfunp and search_lenv1 (node.name, lenv):
                 #print 'adding nonlocal decl for %r to %r' % (node.name, lenv[0].name)
                 lenv[0].nonlocals.add (node.name)
         for sub in node.subs:
-            find_nonlocals (sub, lenv)
+            find_nonlocals (sub, env)
 
 class Sequence (Node):
     def __init__ (self, exp, k):
@@ -168,6 +187,11 @@ class Expression (Node):
         self.subs[0].emit (out)
 
 class FunctionDef (Node):
+
+    # locals that are only assigned inside continuation functions; they're
+    #   bound to None on entry so the continuations' 'nonlocal' can see them.
+    predeclare = ()
+
     def __init__ (self, name, kfunp, args, decorator_list, body, k):
         nonlocals = set()
         yeslocals = set()
@@ -195,6 +219,8 @@ class FunctionDef (Node):
         out.indent()
         if nonlocals:
             out ('nonlocal %s' % (', '.join (nonlocals),))
+        for x in sorted (self.predeclare):
+            out ('%s = None' % (x,))
         self.subs[0].emit_all (out)
         out.dedent()
         
@@ -256,11 +282,30 @@ class Call (Node):
     def emit (self, out):
         out ('%s%s (%s)' % (self.prefix(), self.vars[0], ', '.join (self.vars[1:])))
 
+# invoking a continuation: '<target> (<args>)', or when it goes through a
+#   scheduler, '<via> (<target>, <args>)'.
+class Invoke (Node):
+    def __init__ (self, target, args, via=None):
+        Node.__init__ (self, [], NullCont, [target] + args, params=via)
+    @property
+    def target (self):
+        return self.vars[0]
+    def emit (self, out):
+        if self.params:
+            out ('%s (%s)' % (self.params, ', '.join (self.vars)))
+        else:
+            out ('%s (%s)' % (self.vars[0], ', '.join (self.vars[1:])))
+
 class Num (Node):
     def __init__ (self, value, k):
         Node.__init__ (self, [], k, params=value)
     def emit (self, out):
-        out ('%s%r' % (self.prefix(), self.params.n,))
+        # ast.Constant (3.8+) spells it 'value', the old ast.Num 'n'.
+        if isinstance (self.params, ast.Constant):
+            value = self.params.value
+        else:
+            value = self.params.n
+        out ('%s%r' % (self.prefix(), value))
 
 class Name (Node):
     def __init__ (self, name, k):
@@ -310,12 +355,18 @@ class Verbatim (Node):
     def __init__ (self, exp, k):
         Node.__init__ (self, [], k, params=exp)
     def emit (self, out):
-        import io
-        f = io.StringIO()
-        unparse.Unparser (self.params, f)
-        src = f.getvalue()
-        for line in src.split ('\n'):
-            out (line)
+        out.verbatim (self.params)
+
+# the body of a @cps_manual primitive, inlined at a call site: its formals
+#   (renamed apart) are bound to <vars> first, so that passes which rename
+#   variables see them.
+class InlinedPrimitive (Node):
+    def __init__ (self, body, formals, vars):
+        Node.__init__ (self, [], NullCont, vars, params=(body, formals))
+    def emit (self, out):
+        body, formals = self.params
+        out ('%s = %s' % (', '.join (formals), ', '.join (self.vars)))
+        out.verbatim (body)
 
 class Cont:
     def __init__ (self, name, exp):
@@ -336,11 +387,157 @@ def dead_cont (genk):
 
 NullCont = Cont ('', None)
 
+# simplification of the CPS tree (transform (..., optimize=True)).
+#
+# the transform leaves lots of continuations that do nothing interesting:
+#   * 'forwarding' continuations whose body just invokes another one with
+#     the same args (def kf2 (v8): k (v8)) - every use is replaced with
+#     the one it forwards to.
+#   * dead continuations that do nothing at all (def kf0 (): pass) - calls
+#     to them are dropped, and so are they, if nothing else refers to them.
+#   * continuations invoked from exactly one place (e.g. the join of an
+#     'if' where the other branch returns) - the body is inlined there.
+#   * Expr nodes, which only ever emit 'pass'.
+#
+# continuation function names are unique, so all of this works on names.
+
+def is_kfun (node):
+    return isinstance (node, FunctionDef) and node.kfunp
+
+def is_noop (node):
+    for n in walk (node):
+        if not isinstance (n, Expr):
+            return False
+    return True
+
+class simplifier:
+
+    def __init__ (self):
+        self.aliases = {}
+        self.noops = set()
+        self.uses = {}
+        # continuations invoked once, from after their definition
+        self.inline = set()
+
+    def run (self, root):
+        self.find_aliases (root)
+        self.count_uses (root, set(), set())
+        pending = {}
+        root = self.rewrite_chain (root, pending)
+        assert not pending
+        return root
+
+    def resolve (self, name):
+        while name in self.aliases:
+            name = self.aliases[name]
+        return name
+
+    # pass 1: forwarding and no-op continuations
+    def find_aliases (self, root):
+        for node in walk (root):
+            if is_kfun (node):
+                self.uses[node.name] = 0
+                body = node.subs[0]
+                while isinstance (body, Expr) and body.k.exp:
+                    body = body.k.exp
+                formals = [ x.arg for x in node.formals.args ]
+                if (isinstance (body, Invoke)
+                    and body.vars[1:] == formals
+                    and body.target != node.name):
+                    self.aliases[node.name] = body.target
+                elif not formals and is_noop (body):
+                    self.noops.add (node.name)
+            for sub in node.subs:
+                if sub:
+                    self.find_aliases (sub)
+
+    # pass 2: apply the aliases, and count the remaining uses
+    def count_uses (self, root, defined, inside):
+        for node in walk (root):
+            node.vars = [ self.resolve (v) for v in node.vars ]
+            if isinstance (node, Invoke) and node.target in self.noops:
+                continue
+            for i, v in enumerate (node.vars):
+                if v in self.uses:
+                    self.uses[v] += 1
+                    if (i == 0 and isinstance (node, Invoke)
+                        and v in defined and v not in inside):
+                        self.inline.add (v)
+                    else:
+                        self.inline.discard (v)
+            if is_kfun (node):
+                defined.add (node.name)
+                self.count_uses (node.subs[0], defined, inside | set ([node.name]))
+            else:
+                for sub in node.subs:
+                    if sub:
+                        self.count_uses (sub, defined, inside)
+
+    # pass 3: rebuild each chain without the dead nodes, inlining as we go.
+    def rewrite_chain (self, head, pending):
+        out = []
+        for node in walk (head):
+            node.subs = [ sub and self.rewrite_chain (sub, pending) for sub in node.subs ]
+            if isinstance (node, Expr):
+                pass
+            elif is_kfun (node) and node.name in self.aliases:
+                pass
+            elif is_kfun (node) and self.uses[node.name] == 0:
+                pass
+            elif is_kfun (node) and self.uses[node.name] == 1 and node.name in self.inline:
+                pending[node.name] = node
+            elif isinstance (node, Invoke) and node.target in self.noops:
+                pass
+            elif isinstance (node, Invoke) and node.target in pending:
+                fun = pending.pop (node.target)
+                # bind the continuation's formals to the args it was invoked with.
+                for formal, arg in zip (fun.formals.args, node.vars[1:]):
+                    out.append (Name (ast.Name (arg, ast.Load()), Cont (formal.arg, None)))
+                out.extend (walk (fun.subs[0]))
+            else:
+                out.append (node)
+        # relink
+        if not out:
+            return Expr (NullCont)
+        for i in range (len (out) - 1):
+            out[i].k = Cont (out[i].k.name or '_', out[i+1])
+        last = out[-1]
+        if last.k.name in ('', '_'):
+            last.k = NullCont
+        return out[0]
+
+def simplify (root):
+    return simplifier().run (root)
+
 class transformer:
 
-    def __init__ (self, cps_prefix='cps_'):
+    def __init__ (self, cps_prefix='cps_', dual=False,
+                  inline=False, inline_size=40, inline_depth=2, inline_growth=2000):
         self.cps_prefix = cps_prefix
         self.env = []
+        # with <dual>, cps_ functions that can never suspend also get a
+        #   direct-style twin, and CPS callers use that instead.
+        self.dual = dual
+        self.never_suspend = set()
+        # with <inline>, calls to small cps_ functions are replaced by their
+        #   bodies: see inline_candidate().
+        self.inline = inline
+        self.inline_size = inline_size
+        self.inline_depth = inline_depth
+        self.inline_growth = inline_growth
+        self.functions = {}
+        self.inlining = []
+        self.inline_counter = 0
+        # where 'return' sends its value: 'k', or the continuation of an
+        #   inlined call.
+        self.return_k = 'k'
+        # the enclosing loops, innermost last: (head, exit) continuation
+        #   names, for 'continue' and 'break'.
+        self.loops = []
+        # inside a real cps_ function, rather than at module level
+        self.in_function = False
+        # every loop's head name -> (exit name, line), for cost_report().
+        self.loop_info = {}
 
     def t_exp (self, node, k):
         if isinstance (node, list):
@@ -369,8 +566,185 @@ class transformer:
                 )
 
     def t_Module (self, node, k):
+        if self.dual:
+            self.never_suspend = self.find_never_suspend (node.body)
+        if self.inline:
+            self.functions = self.find_inlinable (node.body)
         return Module (self.t_sequence (node.body, k), k)
 
+    # dual compilation.
+    #
+    # a cps_ function 'may suspend' if it calls a @cps_manual primitive, or
+    #   any cps_ function we can't see (an attribute, or one imported from
+    #   elsewhere), or one that may suspend.  The rest only ever return a
+    #   value to their continuation, so they can be compiled as ordinary
+    #   python functions, with no continuation closures at all.  Note that
+    #   they then use the real python stack: deep recursion in such a
+    #   function is subject to the recursion limit again.
+
+    def is_manual (self, node):
+        for dec in node.decorator_list:
+            if isinstance (dec, ast.Name) and dec.id == 'cps_manual':
+                return True
+        return False
+
+    def find_never_suspend (self, body):
+        calls = {}
+        for stmt in body:
+            if (isinstance (stmt, ast.FunctionDef)
+                and self.name_is_cps (stmt.name)
+                and not self.is_manual (stmt)):
+                callees = set()
+                for sub in ast.walk (stmt):
+                    if isinstance (sub, ast.Call) and self.fun_is_cps (sub.func):
+                        if isinstance (sub.func, ast.Name):
+                            callees.add (sub.func.id)
+                        else:
+                            callees.add (None)
+                calls[stmt.name] = callees
+        may = set()
+        changed = True
+        while changed:
+            changed = False
+            for name, callees in calls.items():
+                if name not in may:
+                    for callee in callees:
+                        if callee not in calls or callee in may:
+                            may.add (name)
+                            changed = True
+                            break
+        return set (calls) - may
+
+    def direct_name (self, name):
+        return 'direct_' + name
+
+    def direct_function (self, node):
+        # a copy of <node> with calls to never-suspend functions pointed at their twins
+        never_suspend = self.never_suspend
+        direct_name = self.direct_name
+        class renamer (ast.NodeTransformer):
+            def visit_Name (self, node):
+                if node.id in never_suspend:
+                    return ast.copy_location (ast.Name (direct_name (node.id), node.ctx), node)
+                else:
+                    return node
+        direct = renamer().visit (copy.deepcopy (node))
+        direct.name = direct_name (node.name)
+        return direct
+
+    def t_dual_FunctionDef (self, node, k):
+        # def cps_f (x): <body>
+        # =>
+        # def direct_cps_f (x): <body, calling direct_ versions>
+        # def cps_f (k, x): k (direct_cps_f (x))
+        direct = self.direct_function (node)
+        call = ast.Call (
+            ast.Name (direct.name, ast.Load()),
+            [ ast.Name (x.arg, ast.Load()) for x in node.args.args ],
+            []
+            )
+        wrapper = ast.FunctionDef (node.name, node.args, [ast.Return (call)], [], None)
+        return Verbatim (direct, dead_cont (lambda: self.t_cps_FunctionDef (wrapper, k)))
+
+    # inlining.
+    #
+    # a call to a small, non-recursive cps_ function (or @cps_manual
+    #   primitive) is replaced by the function's body, with its parameters
+    #   renamed to the temporaries holding the arguments, its other locals
+    #   renamed apart, and its 'return' (or for a primitive, its 'k')
+    #   pointed at the continuation of the call.  The arguments are always
+    #   fresh temporaries, so the body can't clobber anything of ours.
+    #
+    # primitives are inlined verbatim, so they may not use 'return'.  cps_
+    #   functions with loops aren't inlined: the loop's variables would need
+    #   'nonlocal' declarations in whatever function they land in, and the
+    #   call may be at module level.  For the same reason, a cps_ function
+    #   that assigns to a name isn't inlined at module level: an assignment
+    #   after a cps_ call lands in a module-level continuation, where it
+    #   would only bind a local of that continuation.
+
+    def find_inlinable (self, body):
+        r = {}
+        for stmt in body:
+            if (isinstance (stmt, ast.FunctionDef)
+                and self.name_is_cps (stmt.name)
+                and self.can_inline (stmt)):
+                size = len (list (ast.walk (stmt)))
+                if size <= self.inline_size:
+                    r[stmt.name] = (copy.deepcopy (stmt), self.is_manual (stmt), size)
+        return r
+
+    def can_inline (self, node):
+        args = node.args
+        if args.vararg or args.kwarg or args.kwonlyargs or args.defaults:
+            return False
+        manual = self.is_manual (node)
+        for sub in ast.walk (node):
+            if sub is node:
+                continue
+            elif isinstance (sub, (ast.FunctionDef, ast.Lambda, ast.ClassDef,
+                                   ast.Global, ast.Nonlocal, ast.While, ast.For)):
+                return False
+            elif isinstance (sub, ast.Return) and manual:
+                return False
+            elif isinstance (sub, ast.Name) and sub.id == node.name:
+                # recursive
+                return False
+        return True
+
+    def inline_candidate (self, func, args):
+        if not (self.inline and isinstance (func, ast.Name) and func.id in self.functions):
+            return None
+        fun, manual, size = self.functions[func.id]
+        if (func.id in self.inlining
+            or len (self.inlining) >= self.inline_depth
+            or size > self.inline_growth
+            or len (args) + manual != len (fun.args.args)):
+            return None
+        if not manual and not self.in_function and self.assigns (fun):
+            return None
+        return fun
+
+    def assigns (self, fun):
+        for sub in ast.walk (fun):
+            if isinstance (sub, ast.Name) and isinstance (sub.ctx, ast.Store):
+                return True
+        return False
+
+    def inline_call (self, fun, vars):
+        # vars = [kfname] + arg temporaries
+        manual = self.is_manual (fun)
+        self.inline_counter += 1
+        suffix = '_i%d' % (self.inline_counter,)
+        params = [ x.arg for x in fun.args.args ]
+        if manual:
+            # bound at run time by InlinedPrimitive, from its vars
+            names = dict ((x, x + suffix) for x in params)
+        else:
+            names = dict (zip (params, vars[1:]))
+        for sub in ast.walk (fun):
+            if isinstance (sub, ast.Name) and isinstance (sub.ctx, ast.Store) and sub.id not in names:
+                names[sub.id] = sub.id + suffix
+        class renamer (ast.NodeTransformer):
+            def visit_Name (self, node):
+                if node.id in names:
+                    return ast.copy_location (ast.Name (names[node.id], node.ctx), node)
+                else:
+                    return node
+        body = [ renamer().visit (stmt) for stmt in copy.deepcopy (fun.body) ]
+        self.inline_growth -= self.functions[fun.name][2]
+        if manual:
+            return InlinedPrimitive (body, [ names[x] for x in params ], vars)
+        else:
+            save = self.return_k
+            self.return_k = vars[0]
+            self.inlining.append (fun.name)
+            try:
+                return self.t_sequence (body, NullCont)
+            finally:
+                self.inlining.pop()
+                self.return_k = save
+
     def t_Assign (self, node, k):
         # for now
         assert (len(node.targets) == 1)
@@ -382,6 +756,9 @@ class transformer:
     def t_Num (self, node, k):
         return Num (node, k)
 
+    # Python 3.8+ parses every literal as ast.Constant.
+    t_Constant = t_Num
+
     def t_Name (self, node, k):
         return Name (node, k)
 
@@ -400,6 +777,15 @@ class transformer:
     def t_BoolOp (self, node, k):
         return self.t_rands ([], node.values, lambda vars: BoolOp (vars, node.op, k))
 
+    def t_orelse (self, orelse, k):
+        # a missing 'else' just goes on to <k>.
+        if orelse:
+            return self.t_exp (orelse, k)
+        elif k.exp is None:
+            return Expr (NullCont)
+        else:
+            return k.exp
+
     def t_If_tail (self, node, k):
         return self.t_exp (
             node.test,
@@ -407,7 +793,7 @@ class transformer:
                 lambda tvar: If (
                     tvar,
                     self.t_exp (node.body, NullCont),
-                    self.t_exp (node.orelse, NullCont)
+                    self.t_orelse (node.orelse, NullCont)
                     )
                 )
             )
@@ -416,9 +802,9 @@ class transformer:
     #   to use a trampoline/scheduler, override this method.
     def invoke_continuation (self, name, dead=False):
         if dead:
-            return dead_cont (lambda: Call (name, [], NullCont))
+            return dead_cont (lambda: Invoke (name, []))
         else:
-            return make_cont (lambda var: Call (name, [var], NullCont))
+            return make_cont (lambda var: Invoke (name, [var]))
 
     def t_If (self, node, k):
         if k.exp is None:
@@ -435,7 +821,7 @@ class transformer:
                         lambda tvar: If (
                             tvar,
                             self.t_exp (node.body, call_kf),
-                            self.t_exp (node.orelse, call_kf)
+                            self.t_orelse (node.orelse, self.invoke_continuation (name, dead=True))
                             )
                         )
                     )
@@ -443,7 +829,7 @@ class transformer:
 
     def t_Return (self, node, k):
         # 'return' == 'feed the result to the continuation'
-        return self.t_exp (node.value, self.invoke_continuation ('k'))
+        return self.t_exp (node.value, self.invoke_continuation (self.return_k))
 
     def t_Attribute (self, node, k):
         return self.t_exp (node.value, make_cont (lambda var: Attribute (var, node.attr, node.ctx, k)))
@@ -455,6 +841,11 @@ class transformer:
         return ((isinstance (node, ast.Name) and self.name_is_cps (node.id))
                 or (isinstance (node, ast.Attribute) and self.name_is_cps (node.attr)))
 
+    # every FunctionDef (real or continuation) is built here, so a subclass
+    #   can substitute its own node classes.
+    def make_function (self, name, kfunp, args, decorator_list, body, k):
+        return FunctionDef (name, kfunp, args, decorator_list, body, k)
+
     def cont_as_function (self, name, k, ck):
         formals = ast.arguments()
         if k.name and k.name != '_':
@@ -462,7 +853,7 @@ class transformer:
             formals.args = [ast.arg (k.name, ast.Param())]
         else:
             formals.args = []
-        return FunctionDef (
+        return self.make_function (
             name,
             True,
             formals,
@@ -477,7 +868,11 @@ class transformer:
         # an async call will require:
         # 1) packaging up the continuation in a local function
         # 2) invoking with the extra continuation argument [and eventually an exception continuation]
-        if self.fun_is_cps (node.func):
+        func = node.func
+        if isinstance (func, ast.Name) and func.id in self.never_suspend:
+            # call the direct-style twin, like any other function
+            func = ast.Name (self.direct_name (func.id), ast.Load())
+        elif self.fun_is_cps (func):
             kfname = 'kf%d' % (self.kf_counter,)
             self.kf_counter += 1
             formal = k.name
@@ -486,18 +881,20 @@ class transformer:
                     node.func,
                     make_cont (lambda fun_var: Call (fun_var, vars, NullCont))
                     )
+            callee = self.inline_candidate (func, node.args)
+            if callee is not None:
+                make_Call = lambda vars: self.inline_call (callee, vars)
             return self.cont_as_function (
                 kfname,
                 k,
                 lambda: self.t_rands ([kfname], node.args, make_Call)
                 )
-        else:
-            def make_Call (vars):
-                return self.t_exp (
-                    node.func,
-                    make_cont (lambda fun_var: Call (fun_var, vars, k))
-                    )
-            return self.t_rands ([], node.args, make_Call)
+        def make_Call (vars):
+            return self.t_exp (
+                func,
+                make_cont (lambda fun_var: Call (fun_var, vars, k))
+                )
+        return self.t_rands ([], node.args, make_Call)
 
     def t_FunctionDef (self, node, k):
         if not self.name_is_cps (node.name):
@@ -506,16 +903,29 @@ class transformer:
             if dec.id == 'cps_manual':
                 node.decorator_list.remove (dec)
                 return Verbatim (node, k)
+        if node.name in self.never_suspend:
+            return self.t_dual_FunctionDef (node, k)
+        return self.t_cps_FunctionDef (node, k)
+
+    def t_cps_FunctionDef (self, node, k):
         #karg = ast.Name ('k', ast.Param())
         karg = ast.arg ('k', ast.Param())
         formals = node.args
         formals.args = [karg] + formals.args
-        return FunctionDef (
+        # a nested function can't break out of our loops.
+        save, self.loops = self.loops, []
+        save_in_function, self.in_function = self.in_function, True
+        try:
+            body = self.t_exp (node.body, NullCont)
+        finally:
+            self.loops = save
+            self.in_function = save_in_function
+        return self.make_function (
             node.name,
             False,
             formals,
             node.decorator_list,
-            self.t_exp (node.body, NullCont),
+            body,
             k
             )
 
@@ -547,6 +957,10 @@ class transformer:
         #     <orelse>
         #     kf()
         # wf()
+        #
+        # in <body>, 'continue' is just wf() and 'break' is kf(), so they
+        #   cost no more than the loop's own calls: the statements after
+        #   them are dead.
         name0 = 'wkf%d' % (self.kf_counter,)
         self.kf_counter += 1
         name1 = 'kf%d' % (self.kf_counter,)
@@ -555,13 +969,15 @@ class transformer:
         call_wkf = self.invoke_continuation (name0, dead=True)
         #call_kf = dead_cont (lambda: Call (name1, [], NullCont))
         call_kf = self.invoke_continuation (name1, dead=True)
+        self.loop_info[name0] = (name1, getattr (node, 'lineno', None))
         def make_while():
             def make_test (tvar):
-                return If (
-                    tvar,
-                    self.t_exp (node.body, call_wkf),
-                    self.t_exp (node.orelse, call_kf)
-                    )
+                self.loops.append ((name0, name1))
+                try:
+                    body = self.t_exp (node.body, call_wkf)
+                finally:
+                    self.loops.pop()
+                return If (tvar, body, self.t_orelse (node.orelse, call_kf))
             return self.cont_as_function (
                 name0, 
                 Cont ('_', self.t_exp (node.test, make_cont (make_test),)),
@@ -569,9 +985,28 @@ class transformer:
                 )
         return self.cont_as_function (name1, k, make_while)
 
+    def t_loop_jump (self, node, which):
+        if not self.loops:
+            raise SyntaxError ("'%s' outside loop" % (node.__class__.__name__.lower(),))
+        return self.invoke_continuation (self.loops[-1][which], dead=True).exp
+
+    def t_Continue (self, node, k):
+        return self.t_loop_jump (node, 0)
+
+    def t_Break (self, node, k):
+        return self.t_loop_jump (node, 1)
+
     def t_Import (self, node, k):
         return Verbatim (node, k)
 
+    # classes are copied as they are: their methods aren't converted, so
+    #   the cps_ protocol has to be followed by hand, as with @cps_manual.
+    def t_ClassDef (self, node, k):
+        return Verbatim (node, k)
+
+    def t_ImportFrom (self, node, k):
+        return Verbatim (node, k)
+
 class writer:
     indent_string = '    '
     def __init__ (self, fout):
@@ -588,6 +1023,11 @@ class writer:
                 'utf-8'
                 )
             )
+    def verbatim (self, tree):
+        # unparse straight into the output at the current level, rather
+        #  than going through a StringIO and re-splitting it into lines.
+        src = unparse.Unparser (tree, None, self.level).getvalue()
+        self.fout.write (bytes (src, 'utf-8'))
 
 def t0():
     exp = ast.parse (s1)
@@ -599,24 +1039,404 @@ def t0():
     w = writer (sys.stdout)
     cps.emit_all (w)
 
-def transform (path, transformer=transformer):
+def transform (path, transformer=transformer, optimize=False, **options):
     src = open (path).read()
     exp = ast.parse (src, path, 'exec')
-    t = transformer()
+    t = transformer (**options)
     cps = t.t_exp (exp, NullCont)
+    if optimize:
+        cps = simplify (cps)
+    find_locals (cps, None)
+    find_nonlocals (cps, None)
+    return cps
+
+# convert a list of statements with transformer <t>, outside of any module.
+def transform_body (body, t, optimize=False):
+    cps = t.t_exp (body, NullCont)
+    if optimize:
+        cps = simplify (cps)
     find_locals (cps, None)
     find_nonlocals (cps, None)
     return cps
 
-def dofile (path):
+# cost report.  what converting each cps_ function costs, read off the
+#   CPS tree and the compiled code, so CI can catch a change that makes
+#   it worse ('transform.py --report', or 'trampoline.py --report' to see
+#   the bounces).  For each function:
+#
+#   continuations    continuation functions it defines: each is a closure
+#                    allocated whenever its definition is reached
+#   nonlocals        its locals that continuations declare 'nonlocal'
+#   cells            cell variables of the converted function
+#   temporaries      temporaries (vN) it assigns or receives
+#   loops            for each while loop, one trip round it on its
+#                    costliest path (taking inner loops zero times): the
+#                    continuations allocated, the cps_ calls made, and the
+#                    bounces through the scheduler - a continuation invoked
+#                    via the runtime, or a call, whose callee returns
+#                    through one.  Without a scheduler, no bounces.
+#   bytes, instructions
+#                    bytecode size and instruction count (with dis) of the
+#                    converted function and all its continuations, and
+#                    bytes_orig, instructions_orig for the original
+
+def _code_size (code):
+    "(bytes, instructions) of <code> and every code object nested in it"
+    import dis, types
+    nbytes = len (code.co_code)
+    ninsns = len (list (dis.get_instructions (code)))
+    for const in code.co_consts:
+        if isinstance (const, types.CodeType):
+            b, i = _code_size (const)
+            nbytes += b
+            ninsns += i
+    return nbytes, ninsns
+
+def _find_code (code, name):
+    import types
+    for const in code.co_consts:
+        if isinstance (const, types.CodeType):
+            if const.co_name == name:
+                return const
+            found = _find_code (const, name)
+            if found is not None:
+                return found
+    return None
+
+def _real_functions (root):
+    # the FunctionDefs of real (not continuation) functions
+    for node in walk (root):
+        if isinstance (node, FunctionDef) and not node.kfunp:
+            yield node
+        for sub in node.subs:
+            if sub:
+                yield from _real_functions (sub)
+
+def _function_nodes (root):
+    # the nodes of a function's body and its continuations, but not of
+    #   any real function nested in it.
+    for node in walk (root):
+        yield node
+        if not (isinstance (node, FunctionDef) and not node.kfunp):
+            for sub in node.subs:
+                if sub:
+                    yield from _function_nodes (sub)
+
+def _costlier (a, b):
+    # (bounces, continuations, calls)
+    if a is None or (b is not None and b > a):
+        return b
+    return a
+
+def _trip (chain, head, kfuns, scheduled, seen):
+    # the costliest path from <chain> back round to the loop <head>, as
+    #   (bounces, continuations, calls), or None if there's none.
+    bounces = made = calls = 0
+    target = None
+    for node in walk (chain):
+        if isinstance (node, FunctionDef) and node.kfunp:
+            made += 1
+        elif isinstance (node, If):
+            rest = None
+            for sub in node.subs:
+                if sub:
+                    rest = _costlier (rest, _trip (sub, head, kfuns, scheduled, seen))
+            break
+        elif isinstance (node, Invoke):
+            bounces += bool (node.params)
+            target = node.target
+            break
+        elif isinstance (node, Call) and not node.k.name and len (node.vars) > 1:
+            # a cps_ call, continuing with its first argument
+            calls += 1
+            bounces += scheduled
+            target = node.vars[1]
+            break
+    else:
+        return None
+    if target is None:
+        pass
+    elif target == head:
+        rest = (0, 0, 0)
+    elif target in kfuns and target not in seen:
+        rest = _trip (kfuns[target].subs[0], head, kfuns, scheduled, seen | set ([target]))
+    else:
+        rest = None
+    if rest is None:
+        return None
+    return (bounces + rest[0], made + rest[1], calls + rest[2])
+
+def cost_report (path, transformer=transformer, optimize=False, **options):
+    "return a list of dicts, one per cps_ function in <path>, describing what converting it costs"
+    import io
+    src = open (path).read()
+    original = compile (src, path, 'exec')
+    lines = {}
+    for node in ast.walk (ast.parse (src, path, 'exec')):
+        if isinstance (node, ast.FunctionDef):
+            lines.setdefault (node.name, node.lineno)
+    t = transformer (**options)
+    cps = transform_body (ast.parse (src, path, 'exec'), t, optimize)
+    scheduled = bool (t.invoke_continuation ('k', dead=True).exp.params)
+    report = []
+    for fun in _real_functions (cps):
+        if not t.name_is_cps (fun.name):
+            continue
+        nodes = list (_function_nodes (fun.subs[0]))
+        kfuns = dict ((n.name, n) for n in nodes if isinstance (n, FunctionDef))
+        nonlocals = set()
+        temps = set()
+        for n in nodes:
+            if n.k.name.startswith ('v'):
+                temps.add (n.k.name)
+            if isinstance (n, FunctionDef):
+                nonlocals.update (n.nonlocals)
+                temps.update (x.arg for x in n.formals.args if x.arg.startswith ('v'))
+        loops = []
+        for head, (exit, line) in sorted (t.loop_info.items(), key=lambda item: item[1][1] or 0):
+            if head in kfuns:
+                trip = _trip (kfuns[head].subs[0], head, kfuns, scheduled, set ([head]))
+                if trip is not None:
+                    bounces, made, calls = trip
+                    loops.append ({'line': line, 'continuations': made, 'calls': calls, 'bounces': bounces})
+        w = writer (io.BytesIO())
+        fun.emit (w)
+        converted = _find_code (compile (w.fout.getvalue(), path, 'exec'), fun.name)
+        r = {
+            'name': fun.name,
+            'line': lines.get (fun.name),
+            'continuations': len (kfuns),
+            'nonlocals': len (nonlocals),
+            'cells': len (converted.co_cellvars),
+            'temporaries': len (temps),
+            'loops': loops,
+            }
+        r['bytes'], r['instructions'] = _code_size (converted)
+        code = _find_code (original, fun.name)
+        if code is not None:
+            r['bytes_orig'], r['instructions_orig'] = _code_size (code)
+        report.append (r)
+    return report
+
+# what may not grow, compared with a baseline report
+cost_keys = ('continuations', 'nonlocals', 'cells', 'temporaries', 'bytes', 'instructions')
+
+def compare_costs (report, baseline):
+    "return a line for each function in <report> that costs more than it did in <baseline>"
+    before = dict (((r.get ('file'), r['name']), r) for r in baseline)
+    bad = []
+    for r in report:
+        b = before.get ((r.get ('file'), r['name']))
+        if b is None:
+            continue
+        for key in cost_keys:
+            if r[key] > b[key]:
+                bad.append ('%s %s: %s %d, was %d' % (r.get ('file'), r['name'], key, r[key], b[key]))
+        for i, (loop, was) in enumerate (zip (r['loops'], b['loops'])):
+            for key in ('continuations', 'calls', 'bounces'):
+                if loop[key] > was[key]:
+                    bad.append ('%s %s: loop %d %s %d, was %d' % (r.get ('file'), r['name'], i, key, loop[key], was[key]))
+    return bad
+
+def report_main (paths, transformer=transformer, baseline=None, **options):
+    "print the cost report for <paths> as JSON; with <baseline> (a file), exit 1 if anything costs more"
+    import json
+    report = []
+    for path in paths:
+        for r in cost_report (path, transformer, **options):
+            r['file'] = path
+            report.append (r)
+    print (json.dumps (report, indent=1))
+    if baseline is not None:
+        with open (baseline) as f:
+            bad = compare_costs (report, json.load (f))
+        for line in bad:
+            sys.stderr.write ('regression: %s\n' % (line,))
+        if bad:
+            sys.exit (1)
+
+# incremental re-transform, for a dev server (or anything else) that
+#   converts the same file again after small edits.
+#
+# The source is cut into top-level chunks at column-0 lines, without
+#   parsing the whole file: each top-level def (with its decorators) is a
+#   chunk, and so is each run of other statements.  The emitted code for a
+#   def is cached under its source text together with everything else its
+#   output depends on: the transformer and its options, the set of
+#   never-suspending functions with --dual, and the source of the inlinable
+#   functions with --inline.  After an edit only the changed defs are
+#   parsed, transformed and analysed again, and the cached output of the
+#   rest is spliced back in.  The module-level statements are always
+#   transformed again (they're usually a handful of lines), each run of
+#   them emitted where it appears, so an import still runs before the
+#   defs whose decorators or defaults use it.  A module-level cps_ call
+#   makes the rest of the module its continuation, so from the first run
+#   that makes one, everything after it - defs included - is transformed
+#   as one sequence, uncached, just as a full transform would.
+#
+# Not for lift.py, whose continuation functions are hoisted to module
+#   level and so aren't private to the def they came from.
+
+# a column-0 line that continues the statement before it
+_continuation_line = re.compile (r'(else|elif|except|finally)\b|[)\]}]')
+
+def split_chunks (src):
+    "split <src> into (first line number, text) for each top-level statement"
+    chunks = []
+    lines = src.splitlines (True)
+    start = 0
+    decorated = False
+    for i, line in enumerate (lines):
+        c = line[:1]
+        if c in ('', ' ', '\t', '\n', '\r', '#', '\f') or _continuation_line.match (line):
+            continue
+        if i > start and not decorated:
+            chunks.append ((start + 1, ''.join (lines[start:i])))
+            start = i
+        decorated = (c == '@')
+    if start < len (lines):
+        chunks.append ((start + 1, ''.join (lines[start:])))
+    return chunks
+
+class _chunk:
+    def __init__ (self, text, tree):
+        self.text = text
+        # the pristine parse: transforming changes the tree.
+        self.tree = tree
+        self.is_def = len (tree.body) == 1 and isinstance (tree.body[0], ast.FunctionDef)
+        # the emitted code, for each context it has been transformed in.
+        self.output = {}
+
+class transform_cache:
+
+    def __init__ (self):
+        # chunk text -> _chunk
+        self.chunks = {}
+        # stats for the last call
+        self.hits = 0
+        self.misses = 0
+
+    def parse (self, path, src):
+        # returns the list of chunks, parsing only the text we haven't seen.
+        #   a piece that doesn't parse on its own (a column-0 line inside a
+        #   string or a bracket) is joined to the next one.
+        result = []
+        pending = None
+        for lineno, text in split_chunks (src):
+            if pending is not None:
+                lineno, text = pending[0], pending[1] + text
+                pending = None
+            chunk = self.chunks.get (text)
+            if chunk is None:
+                try:
+                    tree = ast.parse (text, path, 'exec')
+                except SyntaxError:
+                    pending = (lineno, text)
+                    continue
+                ast.increment_lineno (tree, lineno - 1)
+                chunk = _chunk (text, tree)
+            result.append (chunk)
+        if pending is not None:
+            # report the error against the whole file.
+            ast.parse (src, path, 'exec')
+        # forget chunks that are gone, so an edited file doesn't grow the cache.
+        self.chunks = dict ((chunk.text, chunk) for chunk in result)
+        return result
+
+    def emit (self, body, t, optimize, w):
+        transform_body (body, t, optimize).emit_all (w)
+
+    def transform (self, path, transformer=transformer, optimize=False, **options):
+        "return the converted module body as bytes, re-using what we can from the last call"
+        import io
+        src = open (path).read()
+        chunks = self.parse (path, src)
+        t = transformer (**options)
+        defs = [ chunk.tree.body[0] for chunk in chunks if chunk.is_def ]
+        context = [transformer, optimize, sorted (options.items())]
+        if t.dual:
+            t.never_suspend = t.find_never_suspend (defs)
+            context.append (sorted (t.never_suspend))
+        if t.inline:
+            t.functions = t.find_inlinable (defs)
+            context.append ([ chunk.text for chunk in chunks if chunk.is_def and chunk.tree.body[0].name in t.functions ])
+        context = repr (context)
+        self.hits = self.misses = 0
+        out = io.BytesIO()
+        # module-level statements not yet emitted
+        body = []
+        tail = False
+        for chunk in chunks:
+            if not chunk.is_def or tail:
+                body.extend (chunk.tree.body)
+                tail = tail or self.calls_cps (chunk.tree, t)
+                continue
+            if body:
+                self.emit_statements (body, t, optimize, out)
+                body = []
+            code = chunk.output.get (context)
+            if code is None:
+                self.misses += 1
+                fout = io.BytesIO()
+                self.emit (ast.parse (chunk.text, path, 'exec').body, t, optimize, writer (fout))
+                # only one context is worth keeping: the next call will
+                #   almost always be made with the same one.
+                code = fout.getvalue()
+                chunk.output = {context: code}
+            else:
+                self.hits += 1
+            out.write (code)
+        if body:
+            self.emit_statements (body, t, optimize, out)
+        return out.getvalue()
+
+    def calls_cps (self, tree, t):
+        for node in ast.walk (tree):
+            if isinstance (node, ast.Call) and t.fun_is_cps (node.func):
+                return True
+        return False
+
+    def emit_statements (self, body, t, optimize, out):
+        # not through t_Module: that would redo the analyses above on
+        #   these statements alone.  The chunks' trees stay pristine.
+        self.emit (copy.deepcopy (body), t, optimize, writer (out))
+
+# with a transform_cache, only what changed since the last call is converted again.
+def dofile (path, cache=None, **options):
     import os
-    cps = transform (path)
     base, ext = os.path.splitext (path)
-    fout = open (base + '.cps.py', 'wb')
-    w = writer (fout)
-    cps.emit_all (w)
+    if cache is not None:
+        code = cache.transform (path, **options)
+        fout = open (base + '.cps.py', 'wb')
+        fout.write (code)
+    else:
+        cps = transform (path, **options)
+        fout = open (base + '.cps.py', 'wb')
+        w = writer (fout)
+        cps.emit_all (w)
     fout.close()
 
 if __name__ == '__main__':
-    for path in sys.argv[1:]:
-        dofile (path)
+    args = sys.argv[1:]
+    options = {}
+    report = False
+    baseline = None
+    while args and args[0].startswith ('-'):
+        arg = args.pop (0)
+        if arg == '--dual':
+            options['dual'] = True
+        elif arg == '--inline':
+            options['inline'] = True
+        elif arg == '-O':
+            options['optimize'] = True
+        elif arg == '--report':
+            report = True
+        elif arg.startswith ('--baseline='):
+            baseline = arg[len('--baseline='):]
+        else:
+            raise ValueError (arg)
+    if report:
+        report_main (args, baseline=baseline, **options)
+    else:
+        for path in args:
+            dofile (path, **options)
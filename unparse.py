@@ -2,7 +2,7 @@
 # Note: from Python-3.2.2/Tools/parser/unparse.py
 #
 
-"Usage: unparse.py <path to source file>"
+"Usage: unparse.py [--jobs=N] [--testdir] <path to source file or dir>"
 import sys
 import math
 import ast
@@ -32,22 +32,29 @@ class Unparser:
     output source code for the abstract syntax; original formatting
     is disregarded. """
 
-    def __init__(self, tree, file = sys.stdout):
-        """Unparser(tree, file=sys.stdout) -> None.
+    def __init__(self, tree, file = sys.stdout, indent = 0):
+        """Unparser(tree, file=sys.stdout, indent=0) -> None.
          Print the source for tree to file."""
         self.f = file
-        self._indent = 0
+        self._indent = indent
+        self._out = []
         self.dispatch(tree)
-        print("", file=self.f)
-        self.f.flush()
+        self._out.append("\n")
+        if self.f is not None:
+            self.f.write("".join(self._out))
+            self.f.flush()
+
+    def getvalue(self):
+        "Return the source collected so far."
+        return "".join(self._out)
 
     def fill(self, text = ""):
         "Indent a piece of text, according to the current indentation level"
-        self.f.write("\n"+"    "*self._indent + text)
+        self._out.append("\n"+"    "*self._indent + text)
 
     def write(self, text):
         "Append a piece of text to the current line."
-        self.f.write(text)
+        self._out.append(text)
 
     def enter(self):
         "Print ':', and increase the indentation."
@@ -64,8 +71,20 @@ class Unparser:
             for t in tree:
                 self.dispatch(t)
             return
-        meth = getattr(self, "_"+tree.__class__.__name__)
-        meth(tree)
+        cls = tree.__class__
+        try:
+            meth = self._dispatch_table[cls]
+        except KeyError:
+            meth = self._dispatch_table[cls] = getattr(self.__class__, "_"+cls.__name__)
+        meth(self, tree)
+
+    def __init_subclass__(cls, **kw):
+        # each subclass gets its own table, so overrides are honoured.
+        super().__init_subclass__(**kw)
+        cls._dispatch_table = {}
+
+    # AST class -> unbound _T method, filled in lazily by dispatch()
+    _dispatch_table = {}
 
 
     ############### Unparsing methods ######################
@@ -151,6 +170,12 @@ class Unparser:
             self.dispatch(t.value)
         self.write(")")
 
+    def _YieldFrom(self, t):
+        self.write("(")
+        self.write("yield from ")
+        self.dispatch(t.value)
+        self.write(")")
+
     def _Raise(self, t):
         self.fill("raise")
         if not t.exc:
@@ -162,6 +187,24 @@ class Unparser:
             self.write(" from ")
             self.dispatch(t.cause)
 
+    def _Try(self, t):
+        self.fill("try")
+        self.enter()
+        self.dispatch(t.body)
+        self.leave()
+        for ex in t.handlers:
+            self.dispatch(ex)
+        if t.orelse:
+            self.fill("else")
+            self.enter()
+            self.dispatch(t.orelse)
+            self.leave()
+        if t.finalbody:
+            self.fill("finally")
+            self.enter()
+            self.dispatch(t.finalbody)
+            self.leave()
+
     def _TryExcept(self, t):
         self.fill("try")
         self.enter()
@@ -219,12 +262,12 @@ class Unparser:
             if comma: self.write(", ")
             else: comma = True
             self.dispatch(e)
-        if t.starargs:
+        if getattr(t, "starargs", None):
             if comma: self.write(", ")
             else: comma = True
             self.write("*")
             self.dispatch(t.starargs)
-        if t.kwargs:
+        if getattr(t, "kwargs", None):
             if comma: self.write(", ")
             else: comma = True
             self.write("**")
@@ -300,13 +343,16 @@ class Unparser:
 
     def _With(self, t):
         self.fill("with ")
+        interleave(lambda: self.write(", "), self.dispatch, t.items)
+        self.enter()
+        self.dispatch(t.body)
+        self.leave()
+
+    def _withitem(self, t):
         self.dispatch(t.context_expr)
         if t.optional_vars:
             self.write(" as ")
             self.dispatch(t.optional_vars)
-        self.enter()
-        self.dispatch(t.body)
-        self.leave()
 
     # expr
     def _Bytes(self, t):
@@ -315,6 +361,46 @@ class Unparser:
     def _Str(self, tree):
         self.write(repr(tree.s))
 
+    def _JoinedStr(self, t):
+        self.write("f")
+        string = io.StringIO()
+        self._fstring_JoinedStr(t, string.write)
+        self.write(repr(string.getvalue()))
+
+    def _FormattedValue(self, t):
+        self.write("f")
+        string = io.StringIO()
+        self._fstring_FormattedValue(t, string.write)
+        self.write(repr(string.getvalue()))
+
+    def _fstring_JoinedStr(self, t, write):
+        for value in t.values:
+            meth = getattr(self, "_fstring_" + type(value).__name__)
+            meth(value, write)
+
+    def _fstring_Str(self, t, write):
+        write(t.s.replace("{", "{{").replace("}", "}}"))
+
+    def _fstring_Constant(self, t, write):
+        write(t.value.replace("{", "{{").replace("}", "}}"))
+
+    def _fstring_FormattedValue(self, t, write):
+        write("{")
+        expr = io.StringIO()
+        Unparser(t.value, expr)
+        expr = expr.getvalue().rstrip("\n")
+        if expr.startswith("{"):
+            # keep it from reading as an escaped '{{'
+            write(" ")
+        write(expr)
+        if t.conversion != -1:
+            write("!" + chr(t.conversion))
+        if t.format_spec:
+            write(":")
+            meth = getattr(self, "_fstring_" + type(t.format_spec).__name__)
+            meth(t.format_spec, write)
+        write("}")
+
     def _Name(self, t):
         self.write(t.id)
 
@@ -322,6 +408,15 @@ class Unparser:
         # Substitute overflowing decimal literal for AST infinities.
         self.write(repr(t.n).replace("inf", INFSTR))
 
+    def _Constant(self, t):
+        # Python 3.8+ folds Num/Str/Bytes/NameConstant/Ellipsis into Constant.
+        if t.value is Ellipsis:
+            self.write("...")
+        elif isinstance(t.value, (int, float, complex)) and not isinstance(t.value, bool):
+            self.write(repr(t.value).replace("inf", INFSTR))
+        else:
+            self.write(repr(t.value))
+
     def _List(self, t):
         self.write("[")
         interleave(lambda: self.write(", "), self.dispatch, t.elts)
@@ -458,12 +553,12 @@ class Unparser:
             if comma: self.write(", ")
             else: comma = True
             self.dispatch(e)
-        if t.starargs:
+        if getattr(t, "starargs", None):
             if comma: self.write(", ")
             else: comma = True
             self.write("*")
             self.dispatch(t.starargs)
-        if t.kwargs:
+        if getattr(t, "kwargs", None):
             if comma: self.write(", ")
             else: comma = True
             self.write("**")
@@ -521,7 +616,9 @@ class Unparser:
             if first:first = False
             else: self.write(", ")
             self.write("*")
-            if t.vararg:
+            if isinstance(t.vararg, ast.arg):
+                self.dispatch(t.vararg)
+            elif t.vararg:
                 self.write(t.vararg)
                 if t.varargannotation:
                     self.write(": ")
@@ -541,14 +638,22 @@ class Unparser:
         if t.kwarg:
             if first:first = False
             else: self.write(", ")
-            self.write("**"+t.kwarg)
-            if t.kwargannotation:
+            self.write("**")
+            if isinstance(t.kwarg, ast.arg):
+                self.dispatch(t.kwarg)
+            else:
+                self.write(t.kwarg)
+            if getattr(t, "kwargannotation", None):
                 self.write(": ")
                 self.dispatch(t.kwargannotation)
 
     def _keyword(self, t):
-        self.write(t.arg)
-        self.write("=")
+        if t.arg is None:
+            # **kwargs in a call, since 3.5
+            self.write("**")
+        else:
+            self.write(t.arg)
+            self.write("=")
         self.dispatch(t.value)
 
     def _Lambda(self, t):
@@ -574,28 +679,54 @@ def roundtrip(filename, output=sys.stdout):
 
 
 
-def testdir(a):
+def _testfile(fullname):
+    "Round-trip one file, returning None or a description of the failure."
+    try:
+        roundtrip(fullname, io.StringIO())
+    except Exception as e:
+        return repr(e)
+    return None
+
+def _findfiles(a, found):
     try:
-        names = [n for n in os.listdir(a) if n.endswith('.py')]
+        names = os.listdir(a)
     except OSError:
         print("Directory not readable: %s" % a, file=sys.stderr)
+        return found
+    for n in names:
+        fullname = os.path.join(a, n)
+        if os.path.isdir(fullname):
+            _findfiles(fullname, found)
+        elif n.endswith('.py') and os.path.isfile(fullname):
+            found.append(fullname)
+    return found
+
+def testdir(a, jobs=None):
+    """Round-trip every .py file below a.  The files are spread over a
+    process pool of jobs workers (default: one per CPU); jobs=1 runs
+    them in this process."""
+    names = _findfiles(a, [])
+    if jobs == 1 or len(names) < 2:
+        _report(names, map(_testfile, names))
     else:
-        for n in names:
-            fullname = os.path.join(a, n)
-            if os.path.isfile(fullname):
-                output = io.StringIO()
-                print('Testing %s' % fullname)
-                try:
-                    roundtrip(fullname, output)
-                except Exception as e:
-                    print('  Failed to compile, exception is %s' % repr(e))
-            elif os.path.isdir(fullname):
-                testdir(fullname)
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            chunksize = max(1, len(names) // 64)
+            _report(names, pool.map(_testfile, names, chunksize=chunksize))
+
+def _report(names, results):
+    for fullname, error in zip(names, results):
+        print('Testing %s' % fullname)
+        if error is not None:
+            print('  Failed to compile, exception is %s' % error)
 
 def main(args):
+    jobs = None
+    if args and args[0].startswith('--jobs='):
+        jobs = int(args.pop(0)[len('--jobs='):])
     if args[0] == '--testdir':
         for a in args[1:]:
-            testdir(a)
+            testdir(a, jobs)
     else:
         for a in args:
             roundtrip(a)